@@ -6,6 +6,7 @@ from flask_login import LoginManager
 import logging
 from logging.handlers import SMTPHandler, RotatingFileHandler
 import os
+import atexit
 from flask_mail import Mail
 from flask_moment import Moment
 from flask_babel import Babel
@@ -13,6 +14,8 @@ from flask_babel import lazy_gettext as _l
 from elasticsearch import Elasticsearch
 from redis import Redis
 import rq
+from app.cache import LRUCache, TokenCache
+from app.passwords import PasswordHasher
 
 # Initialise translations and languages
 def get_locale():
@@ -45,8 +48,72 @@ def create_app(config_class=Config):
     babel.init_app(app)
     app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
         if app.config['ELASTICSEARCH_URL'] else None
+
+    from app.search import create_backend, SearchCache
+    app.search_backend = create_backend(app)
+    app.search_cache = SearchCache(
+        'search', app.config['SEARCH_CACHE_SIZE'],
+        ttl=app.config['SEARCH_CACHE_TTL'],
+        report_every=app.config['SEARCH_CACHE_REPORT_EVERY'],
+        refresh_interval=app.config['SEARCH_REFRESH_INTERVAL']
+        if app.config['SEARCH_BACKEND'] == 'elasticsearch' else 0)
     app.redis = Redis.from_url(app.config['REDIS_URL'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    app.task_queues = {
+        'high': rq.Queue('microblog-tasks-high', connection=app.redis),
+        'default': rq.Queue('microblog-tasks', connection=app.redis),
+        'bulk': rq.Queue('microblog-tasks-bulk', connection=app.redis),
+    }
+    app.task_queue = app.task_queues['default']
+    app.search_queue = rq.Queue('microblog-search', connection=app.redis)
+
+    app.token_cache = TokenCache(app, 'token', app.config['TOKEN_CACHE_SIZE'],
+                                 ttl=app.config['TOKEN_CACHE_TTL'])
+
+    from app.translate import HTTPClient
+    app.translator = HTTPClient(
+        app.config['TRANSLATOR_CONCURRENCY'],
+        (app.config['TRANSLATOR_CONNECT_TIMEOUT'],
+         app.config['TRANSLATOR_READ_TIMEOUT']),
+        app.config['TRANSLATOR_RETRIES'],
+        app.config['TRANSLATOR_FAILURE_THRESHOLD'],
+        app.config['TRANSLATOR_RESET_TIMEOUT'], name='translator')
+    app.translation_cache = LRUCache(
+        'translation', app.config['TRANSLATION_CACHE_SIZE'],
+        ttl=app.config['TRANSLATION_CACHE_TTL'])
+
+    app.password_hasher = PasswordHasher(
+        app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_WORKERS'],
+        app.config['PASSWORD_QUEUE_SIZE'],
+        app.config['PASSWORD_QUEUE_TIMEOUT'],
+        app.config['PASSWORD_CONCURRENCY'],
+        app.config['PASSWORD_HASH_TIMEOUT'])
+
+    from app.fragments import FragmentCache, render_posts
+    app.fragment_cache = FragmentCache(
+        'post fragment', app.config['FRAGMENT_CACHE_SIZE'],
+        ttl=app.config['FRAGMENT_CACHE_TTL'],
+        report_every=app.config['FRAGMENT_CACHE_REPORT_EVERY'])
+    app.jinja_env.globals['render_posts'] = render_posts
+
+    from app.activity import LastSeenTracker
+    app.last_seen_tracker = LastSeenTracker(
+        app.config['LAST_SEEN_GRANULARITY'],
+        app.config['LAST_SEEN_FLUSH_INTERVAL'], app)
+
+    @atexit.register
+    def flush_last_seen():
+        with app.app_context():
+            app.last_seen_tracker.flush()
+
+    from app.email import MailDispatcher
+    app.mail_dispatcher = MailDispatcher(
+        app, app.config['MAIL_WORKERS'], app.config['MAIL_QUEUE_SIZE'],
+        app.config['MAIL_BATCH_SIZE'], app.config['MAIL_RETRIES'],
+        app.config['MAIL_BACKOFF'], app.config['MAIL_IDLE_TIMEOUT'])
+
+    @atexit.register
+    def flush_mail():
+        app.mail_dispatcher.flush(app.config['MAIL_FLUSH_TIMEOUT'])
     
     # Get blueprints
     from app.errors import bp as errors_bp
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+import sqlalchemy as sa
+from app import db
+from app.models import User
+
+
+# Coalesces User.last_seen writes: activity is only recorded once the stored
+# value is older than `granularity` seconds, and recorded values are buffered
+# and written with a single UPDATE ... CASE at most every `flush_interval`.
+# Given the application, a background thread flushes every `flush_interval`
+# seconds, so buffered values are written even when no request comes in;
+# without it the flush happens on the next touch() that is due.
+class LastSeenTracker:
+    def __init__(self, granularity=60, flush_interval=30, app=None):
+        self.granularity = timedelta(seconds=granularity)
+        self.flush_interval = flush_interval
+        self.app = app
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._pid = None
+
+    # the flusher is started on first use, and again in a forked child, which
+    # does not inherit its parent's threads
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._run, name='last-seen', daemon=True) \
+            .start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            with self.app.app_context():
+                try:
+                    self.flush()
+                except Exception:
+                    self.app.logger.exception('Could not record last seen')
+
+    def touch(self, user):
+        now = datetime.now(timezone.utc)
+        if user.last_seen is not None and user.last_seen.replace(
+                tzinfo=timezone.utc) > now - self.granularity:
+            return
+        if self.app is not None and self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            self._pending[user.id] = now
+            due = self.app is None and \
+                time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        user = User.__table__
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(
+                    user.update()
+                    .where(user.c.id.in_(pending))
+                    .values(last_seen=sa.case(pending, value=user.c.id)))
+        except Exception:
+            # keep the values for the next flush, unless newer ones came in
+            with self._lock:
+                for user_id, seen in pending.items():
+                    if self._pending.get(user_id, seen) <= seen:
+                        self._pending[user_id] = seen
+            raise
+        return len(pending)
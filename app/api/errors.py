@@ -14,6 +14,10 @@ def bad_request():
     return error_response(400, message)
 
 
+# Headers such as Retry-After are kept; the body is replaced with JSON
 @bp.errorhandler(HTTPException)
 def handle_exception(e):
-    return error_response(e.code)
\ No newline at end of file
+    payload, status_code = error_response(e.code)
+    headers = [(name, value) for name, value in e.get_headers()
+               if name != 'Content-Type']
+    return payload, status_code, headers
\ No newline at end of file
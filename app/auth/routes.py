@@ -5,12 +5,12 @@ from flask_login import current_user, login_user, logout_user, login_required
 import sqlalchemy as sa
 from app.models import User, Post
 from urllib.parse import urlsplit
-from datetime import datetime, timezone
 from app.auth.email import send_password_reset_email
 from flask_babel import get_locale, _
-from langdetect import detect, LangDetectException
 from app.translate import translate
+from app.language import detect_languages_later
 from app.auth import bp
+from app.pagination import paginate_view
 from app.main.forms import SearchForm
 
 
@@ -20,24 +20,17 @@ from app.main.forms import SearchForm
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        post.add_to_timelines()
         db.session.commit()
+        detect_languages_later([post.id])
         flash(_('Your post is now live!'))
         return redirect(url_for('auth.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('auth.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('auth.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_view(
+        current_user.timeline_posts(), [Post.timestamp, Post.id], 'auth.index')
     return render_template('index.html', title='Home', form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -53,6 +46,7 @@ def login():
             flash('Invalid username or password')
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()  # saves the password hash if it was upgraded
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('auth.index')
@@ -85,25 +79,18 @@ def register():
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('auth.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('auth.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_view(
+        query, [Post.timestamp, Post.id], 'auth.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user, posts=posts,
                            next_url=next_url, prev_url=prev_url, form=form)
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        current_app.last_seen_tracker.touch(current_user)
     g.locale = str(get_locale())
 
 
@@ -169,15 +156,10 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
     query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('auth.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('auth.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template("index.html", title='Explore', posts=posts.items,
+    posts, next_url, prev_url = paginate_view(
+        query, [Post.timestamp, Post.id], 'auth.explore')
+    return render_template("index.html", title='Explore', posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -0,0 +1,139 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from redis.exceptions import RedisError
+
+# Redis channel on which revoked API tokens are announced
+TOKEN_REVOKED_CHANNEL = 'microblog-token-revoked'
+
+
+# Thread-safe in-process LRU cache with optional per-entry expiry. Hit and
+# miss counts are kept so the cache can be sized, and are written to the app
+# logger every `report_every` lookups when that is set.
+class LRUCache:
+    def __init__(self, name, maxsize=1024, ttl=None, report_every=None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.report_every = report_every
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[1] is not None and \
+                    entry[1] <= time.time():
+                del self._data[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+            lookups = self.hits + self.misses
+        if self.report_every and lookups % self.report_every == 0:
+            current_app.logger.info('%s cache: %s', self.name, self.stats())
+        return entry[0] if entry is not None else None
+
+    def set(self, key, value, expires_at=None):
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            expires_at = min(expires_at or float('inf'),
+                             time.time() + self.ttl)
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0
+        }
+
+
+# Cache of API tokens. A token revoked in one process has to leave the caches
+# of all the others, so revocations are published on a Redis channel that
+# every process listens to. Entries are only served while this process is
+# subscribed: without Redis, or after the subscription is lost, the cache is
+# emptied and lookups go to the database until it can subscribe again.
+class TokenCache(LRUCache):
+    def __init__(self, app, *args, retry_interval=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.app = app
+        self.retry_interval = retry_interval
+        self._listener = None
+        self._pid = None
+        self._retry_at = 0.0
+        self._subscribe_lock = threading.Lock()
+
+    def _listening(self):
+        if self._listener is not None and self._pid == os.getpid():
+            return True
+        with self._subscribe_lock:
+            if self._pid != os.getpid():
+                # a forked child does not inherit the listener thread
+                self._pid = os.getpid()
+                self._listener = None
+                self._retry_at = 0.0
+                self.clear()
+            if self._listener is None and time.monotonic() >= self._retry_at:
+                self._retry_at = time.monotonic() + self.retry_interval
+                try:
+                    pubsub = self.app.redis.pubsub()
+                    pubsub.subscribe(**{TOKEN_REVOKED_CHANNEL: self._revoked})
+                    self._listener = pubsub.run_in_thread(
+                        sleep_time=1, daemon=True,
+                        exception_handler=self._lost)
+                except RedisError:
+                    self.app.logger.warning(
+                        'Token cache disabled, cannot subscribe to token '
+                        'revocations', exc_info=True)
+            return self._listener is not None
+
+    def _revoked(self, message):
+        self.delete(message['data'].decode())
+
+    def _lost(self, exception, pubsub, thread):
+        thread.stop()
+        self._listener = None
+        self.clear()
+        self.app.logger.warning('Token cache disabled, lost the token '
+                                'revocation subscription: %s', exception)
+
+    def get(self, key):
+        if not self._listening():
+            return None
+        return super().get(key)
+
+    def set(self, key, value, expires_at=None):
+        if self._listening():
+            super().set(key, value, expires_at=expires_at)
+
+    # Drop the token from the caches of all processes
+    def revoke(self, token):
+        self.delete(token)
+        try:
+            self.app.redis.publish(TOKEN_REVOKED_CHANNEL, token)
+        except RedisError:
+            self.app.logger.warning('Could not publish token revocation',
+                                    exc_info=True)
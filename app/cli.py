@@ -1,6 +1,17 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import click
-from flask import Blueprint
+import sqlalchemy as sa
+from flask import Blueprint, current_app
+from app import db
+from app.models import User, Post, SearchableMixin
+from app.language import detect_language, warm_detector, UNDETERMINED
+from app.translate import prune_translations, pretranslate_posts
+from app.worker import QUEUE_LATENCY_KEY, WORKER_QUEUES, worker_queues, \
+    run_workers
+from app.search import PENDING_OPS_KEY, LAG_KEY, bulk_index, document, \
+    enqueue_index_ops, indexed_ids
 
 bp = Blueprint('cli', __name__, cli_group=None)
 
@@ -36,4 +47,208 @@ def init(lang):
     if os.system(
             'pybabel init -i messages.pot -d app/translations -l ' + lang):
         raise RuntimeError('init command failed')
-    os.remove('messages.pot')
\ No newline at end of file
+    os.remove('messages.pot')
+
+
+@translate.command('prune-cache')
+def prune_cache():
+    """Delete expired cached translations."""
+    click.echo(f'{prune_translations()} cached translations deleted')
+
+@bp.cli.group()
+def timeline():
+    """Materialized home timeline commands."""
+    pass
+
+
+@timeline.command()
+@click.option('--batch-size', default=100, help='Users per commit.')
+def backfill(batch_size):
+    """Rebuild the home timeline of every user."""
+    if not current_app.config['TIMELINE_ENABLED']:
+        raise click.ClickException('TIMELINE_ENABLED is not set')
+    users = db.session.scalars(sa.select(User).order_by(User.id)).all()
+    for i, user in enumerate(users, 1):
+        user.rebuild_timeline()
+        if i % batch_size == 0:
+            db.session.commit()
+    db.session.commit()
+    click.echo(f'Rebuilt {len(users)} timelines')
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized counter commands."""
+    pass
+
+
+@counters.command()
+def rebuild():
+    """Recompute all user counters from the underlying tables."""
+    User.rebuild_counters()
+    db.session.commit()
+    click.echo('Counters rebuilt')
+
+
+@counters.command()
+def check():
+    """Report users whose counters are out of step."""
+    mismatches = User.check_counters()
+    for user_id, name, stored, actual in mismatches:
+        click.echo(f'user {user_id}: {name} is {stored}, should be {actual}')
+    if mismatches:
+        raise click.ClickException(f'{len(mismatches)} counters out of step')
+    click.echo('Counters are consistent')
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+def searchable_models():
+    return {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+
+
+@search.command()
+@click.argument('model', type=click.Choice(sorted(searchable_models())))
+@click.option('--chunk-size', default=500, help='Rows per bulk request.')
+@click.option('--workers', default=4, help='Concurrent bulk requests.')
+@click.option('--new-index', is_flag=True,
+              help='Build a new index and swap it in when complete.')
+@click.option('--restart', is_flag=True, help='Ignore any saved checkpoint.')
+def reindex(model, chunk_size, workers, new_index, restart):
+    """Rebuild the search index of a model, resuming if interrupted."""
+    os.makedirs(current_app.instance_path, exist_ok=True)
+    checkpoint = os.path.join(current_app.instance_path,
+                              f'reindex-{model}.json')
+    if restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    elif os.path.exists(checkpoint):
+        click.echo(f'Resuming from {checkpoint}')
+    result = searchable_models()[model].reindex(
+        chunk_size=chunk_size, workers=workers, checkpoint=checkpoint,
+        new_index=new_index)
+    click.echo('Indexed {indexed} rows into {index}, {failed} failed'.format(
+        **result))
+    if result['failed'] and not result['swapped']:
+        raise click.ClickException(
+            f'{result["index"]} is incomplete; run the command again to '
+            f'resume from the checkpoint')
+    if result['failed']:
+        raise click.ClickException(
+            f'{result["index"]} was swapped in but rows added during the '
+            f'build failed; run the command again to index them')
+
+
+@search.command()
+def status():
+    """Show the asynchronous indexing backlog and lag."""
+    pending = current_app.redis.llen(PENDING_OPS_KEY)
+    lag = current_app.redis.get(LAG_KEY)
+    click.echo(f'{pending} changes pending, last lag '
+               f'{float(lag or 0):.1f}s')
+
+
+@search.command()
+@click.argument('model', type=click.Choice(sorted(searchable_models())))
+@click.option('--chunk-size', default=500, help='Rows checked per request.')
+def reconcile(model, chunk_size):
+    """Index rows of a model that are missing from the search index."""
+    cls = searchable_models()[model]
+    missing = 0
+    last_id = 0
+    while True:
+        ids = db.session.scalars(sa.select(cls.id).where(cls.id > last_id)
+                                 .order_by(cls.id).limit(chunk_size)).all()
+        if not ids:
+            break
+        last_id = ids[-1]
+        absent = sorted(set(ids) - indexed_ids(model, ids))
+        if absent:
+            actions = [('index', model, id, None) for id in absent]
+            if current_app.config['SEARCH_ASYNC']:
+                enqueue_index_ops(actions)
+            else:
+                bulk_index([('index', model, obj.id, document(obj))
+                            for obj in db.session.scalars(
+                                sa.select(cls).where(cls.id.in_(absent)))])
+            missing += len(absent)
+        db.session.expunge_all()
+    click.echo(f'{missing} {model} rows were missing from the index')
+
+
+@bp.cli.command()
+@click.option('--queue', '-q', 'queues', multiple=True,
+              type=click.Choice(WORKER_QUEUES),
+              help='Queue to consume, highest priority first (repeatable). '
+                   'Defaults to all queues.')
+@click.option('--processes', '-n', default=1, help='Worker processes.')
+@click.option('--burst', is_flag=True, help='Exit once the queues are empty.')
+def worker(queues, processes, burst):
+    """Run background task workers."""
+    run_workers(queues or WORKER_QUEUES, processes, burst)
+
+
+@bp.cli.command()
+def queues():
+    """Show the depth and last wait time of each task queue."""
+    latency = current_app.redis.hgetall(QUEUE_LATENCY_KEY)
+    for name in WORKER_QUEUES:
+        queue = worker_queues()[name]
+        wait = float(latency.get(queue.name.encode(), 0))
+        click.echo(f'{name}: {queue.count} queued, last wait {wait:.1f}s')
+
+
+@bp.cli.group()
+def posts():
+    """Post maintenance commands."""
+    pass
+
+
+@posts.command('detect-language')
+@click.option('--batch-size', default=500, help='Posts per commit.')
+@click.option('--processes', default=os.cpu_count(),
+              help='Detector processes.')
+def detect_post_language(batch_size, processes):
+    """Detect the language of posts that have none."""
+    # '' marks posts that failed before UNDETERMINED was stored instead
+    detect = partial(detect_language,
+                     min_length=current_app.config['LANGUAGE_MIN_LENGTH'])
+    detected = 0
+    last_id = 0
+    with ProcessPoolExecutor(processes, initializer=warm_detector) as pool:
+        while True:
+            batch = db.session.scalars(
+                sa.select(Post).where(
+                    Post.id > last_id,
+                    sa.or_(Post.language.is_(None), Post.language == ''))
+                .order_by(Post.id).limit(batch_size)).all()
+            if not batch:
+                break
+            last_id = batch[-1].id
+            languages = pool.map(detect, [post.body for post in batch],
+                                 chunksize=max(1, batch_size // processes))
+            for post, language in zip(batch, languages):
+                post.language = language
+                detected += language != UNDETERMINED
+            db.session.commit()
+            db.session.expunge_all()
+    click.echo(f'{detected} post languages detected')
+
+
+@posts.command()
+@click.option('--limit', type=int, help='Number of recent posts.')
+@click.option('--hours', type=int, help='Only posts from the last N hours.')
+@click.option('--enqueue', is_flag=True,
+              help='Queue the job for a worker instead of running it here.')
+def pretranslate(limit, hours, enqueue):
+    """Translate recent posts into all the supported languages."""
+    if enqueue:
+        current_app.task_queues['bulk'].enqueue(
+            'app.tasks.pretranslate_posts', limit, hours)
+        click.echo('Pretranslation queued')
+        return
+    translated = pretranslate_posts(limit, hours)
+    click.echo(f'{translated} post translations cached')
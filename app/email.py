@@ -0,0 +1,158 @@
+import os
+import queue
+import smtplib
+import threading
+import time
+from flask import current_app
+from flask_mail import Message
+from app import mail
+
+
+# Sends mail on a fixed pool of worker threads. Each worker keeps one SMTP
+# connection open while there is mail to send, takes up to `batch_size`
+# queued messages at a time and retries a failed message on a fresh
+# connection with exponential backoff. The queue is bounded, so a burst of
+# mail cannot open an unbounded number of threads or connections.
+class MailDispatcher:
+    def __init__(self, app, workers=2, queue_size=1000, batch_size=20,
+                 retries=3, backoff=1.0, idle_timeout=30):
+        self.app = app
+        self.workers = workers
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.sent = 0
+        self.failed = 0
+        self._latency = 0.0
+        self._queue = queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pid = None
+
+    # workers are started on first use, and again in a forked child, which
+    # does not inherit its parent's threads
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(self.queue_size)
+            for i in range(self.workers):
+                threading.Thread(target=self._work, name=f'mail-{i}',
+                                 daemon=True).start()
+
+    def submit(self, msg):
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait((msg, time.monotonic()))
+        except queue.Full:
+            current_app.logger.error('Mail queue full, dropped email to %s',
+                                     msg.recipients)
+            return False
+        return True
+
+    # Wait up to `timeout` seconds for the queued mail to be sent
+    def flush(self, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'sent': self.sent,
+            'failed': self.failed,
+            'avg_latency': self._latency / self.sent if self.sent else 0.0
+        }
+
+    def _work(self):
+        with self.app.app_context():
+            connection = None
+            while True:
+                try:
+                    batch = [self._queue.get(
+                        timeout=self.idle_timeout if connection else None)]
+                except queue.Empty:
+                    connection = self._close(connection)
+                    continue
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                start = time.perf_counter()
+                for msg, queued_at in batch:
+                    try:
+                        connection = self._send(connection, msg, queued_at)
+                    except Exception:
+                        current_app.logger.exception(
+                            'Could not send email to %s', msg.recipients)
+                        connection = self._close(connection)
+                    finally:
+                        self._queue.task_done()
+                current_app.logger.info(
+                    'Sent %d emails in %.1f ms, %d queued', len(batch),
+                    (time.perf_counter() - start) * 1000, self._queue.qsize())
+
+    def _send(self, connection, msg, queued_at):
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                connection.send(msg)
+            except smtplib.SMTPRecipientsRefused:
+                current_app.logger.error('Recipients refused email to %s',
+                                         msg.recipients)
+                break
+            except (smtplib.SMTPException, OSError):
+                current_app.logger.warning('Could not send email to %s',
+                                           msg.recipients, exc_info=True)
+                connection = self._close(connection)
+                continue
+            except Exception:
+                # not a delivery problem (e.g. a bad header), so not retried
+                current_app.logger.exception('Could not send email to %s',
+                                             msg.recipients)
+                connection = self._close(connection)
+                break
+            with self._lock:
+                self.sent += 1
+                self._latency += time.monotonic() - queued_at
+            return connection
+        else:
+            current_app.logger.error('Gave up sending email to %s',
+                                     msg.recipients)
+        with self._lock:
+            self.failed += 1
+        return connection
+
+    @staticmethod
+    def _close(connection):
+        if connection is not None:
+            try:
+                connection.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+
+def send_email(subject, sender, recipients, text_body, html_body,
+               attachments=None, sync=False):
+    msg = Message(subject, sender=sender, recipients=recipients)
+    msg.body = text_body
+    msg.html = html_body
+    if attachments:
+        for attachment in attachments:
+            msg.attach(*attachment)
+    if sync:
+        mail.send(msg)
+    else:
+        current_app.mail_dispatcher.submit(msg)
@@ -0,0 +1,124 @@
+import time
+from flask import current_app, g, render_template
+from markupsafe import Markup
+import sqlalchemy as sa
+from redis.exceptions import RedisError
+from app import db
+from app.cache import LRUCache
+from app.models import User, Post, Message
+
+# Redis key holding the version of a post, a message or an author
+VERSION_KEY = 'microblog-fragment-version:{}:{}'
+
+
+# Cache of rendered _post.html fragments. Entries are keyed on the post, the
+# locale and version numbers for the post and its author; bumping a version
+# makes the old entries unreachable and LRU eviction reclaims them. The
+# versions live in Redis so that a change committed by one process reaches
+# the caches of all of them, and expire a little after the fragments cached
+# with them. Without Redis fragments are rendered but not cached, and Redis
+# is tried again after `retry_interval` seconds.
+class FragmentCache(LRUCache):
+    def __init__(self, *args, retry_interval=5, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_interval = retry_interval
+        self._retry_at = 0.0
+
+    # Versions of the given (table, id, author id) entries, fetched with a
+    # single MGET however many there are
+    def versions(self, entries):
+        if time.monotonic() < self._retry_at:
+            return None
+        keys = list(dict.fromkeys(
+            key for table, id, author_id in entries
+            for key in (VERSION_KEY.format(table, id),
+                        VERSION_KEY.format('author', author_id))))
+        if not keys:
+            return []
+        try:
+            versions = dict(zip(keys, current_app.redis.mget(keys)))
+        except RedisError:
+            self._retry_at = time.monotonic() + self.retry_interval
+            return None
+        return [(int(versions[VERSION_KEY.format(table, id)] or 0),
+                 int(versions[VERSION_KEY.format('author', author_id)] or 0))
+                for table, id, author_id in entries]
+
+    # Cache keys for (table, id, author id, language) entries, or None for
+    # all of them when the versions are unavailable
+    def keys(self, entries, locale):
+        versions = self.versions([entry[:3] for entry in entries])
+        if versions is None:
+            return [None] * len(entries)
+        return [(table, id, locale, language) + version
+                for (table, id, author_id, language), version
+                in zip(entries, versions)]
+
+    # Bump the versions of the given (table or 'author', id) pairs. If that
+    # fails this process starts over; the others keep their fragments until
+    # they expire.
+    def invalidate(self, keys):
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for table, id in keys:
+                key = VERSION_KEY.format(table, id)
+                pipe.incr(key)
+                if self.ttl is not None:
+                    pipe.expire(key, int(self.ttl) + 60)
+            pipe.execute()
+        except RedisError:
+            current_app.logger.warning('Could not invalidate fragments',
+                                       exc_info=True)
+            self.clear()
+
+
+# Jinja global used by the list templates in place of {% include %}; also
+# renders private messages, which share the _post.html template. The
+# versions for the whole page are looked up at once.
+def render_posts(posts):
+    posts = list(posts)
+    cache = current_app.fragment_cache
+    # the language is set after the post is first shown, by a background job
+    keys = cache.keys([
+        (post.__tablename__, post.id,
+         post.sender_id if isinstance(post, Message) else post.user_id,
+         getattr(post, 'language', None)) for post in posts], g.locale)
+    fragments = []
+    for post, key in zip(posts, keys):
+        html = cache.get(key) if key is not None else None
+        if html is None:
+            html = render_template('_post.html', post=post)
+            if key is not None:
+                cache.set(key, html)
+        fragments.append(html)
+    return Markup('\n'.join(fragments))
+
+
+# Changed posts and authors are noted after every flush and their versions
+# bumped once the change is committed, so that no process can cache the old
+# version again in between
+def note_changed_fragments(session, flush_context):
+    changed = session.info.setdefault('fragment_versions', set())
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            state = sa.inspect(obj)
+            if state.attrs.username.history.has_changes() or \
+                    state.attrs.email.history.has_changes():
+                changed.add(('author', obj.id))
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Post, Message)):
+            changed.add((obj.__tablename__, obj.id))
+
+
+def invalidate_fragments(session):
+    changed = session.info.pop('fragment_versions', None)
+    if changed:
+        current_app.fragment_cache.invalidate(changed)
+
+
+def discard_changed_fragments(session):
+    session.info.pop('fragment_versions', None)
+
+db.event.listen(db.session, 'after_flush', note_changed_fragments)
+db.event.listen(db.session, 'after_commit', invalidate_fragments)
+db.event.listen(db.session, 'after_rollback', discard_changed_fragments)
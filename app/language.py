@@ -0,0 +1,54 @@
+import sqlalchemy as sa
+from flask import current_app
+from langdetect import DetectorFactory, detect, LangDetectException
+from langdetect.detector_factory import init_factory
+from redis.exceptions import RedisError
+from app import db
+from app.models import Post
+
+# langdetect samples the text at random; a fixed seed makes it deterministic
+DetectorFactory.seed = 0
+
+# Language stored for posts whose language could not be detected, so they
+# are not tried again. Posts from before it was introduced have ''.
+UNDETERMINED = 'und'
+
+
+# Load the language profiles now rather than on the first detection, which
+# otherwise stalls for a few hundred milliseconds
+def warm_detector():
+    init_factory()
+
+
+# Texts shorter than `min_length` are too short to detect reliably and are
+# marked as undetermined
+def detect_language(text, min_length=10):
+    text = text.strip()
+    if len(text) < min_length or not any(c.isalpha() for c in text):
+        return UNDETERMINED
+    try:
+        return detect(text)
+    except LangDetectException:
+        return UNDETERMINED
+
+
+# Set the language of the given posts that have none yet
+def detect_post_languages(post_ids):
+    min_length = current_app.config['LANGUAGE_MIN_LENGTH']
+    posts = db.session.scalars(sa.select(Post).where(
+        Post.id.in_(post_ids), Post.language.is_(None))).all()
+    for post in posts:
+        post.language = detect_language(post.body, min_length)
+    db.session.commit()
+    return len(posts)
+
+
+# Detection runs on the worker; without Redis it is done here instead
+def detect_languages_later(post_ids):
+    try:
+        current_app.task_queues['high'].enqueue(
+            'app.tasks.detect_post_languages', post_ids)
+    except RedisError:
+        current_app.logger.warning('Could not queue language detection',
+                                   exc_info=True)
+        detect_post_languages(post_ids)
@@ -1,16 +1,20 @@
-from flask import render_template, flash, redirect, url_for, request, g, current_app
+from flask import render_template, flash, redirect, url_for, request, g, current_app, \
+    Response, abort
 from app import db
 from app.main.forms import LoginForm, RegistrationForm, EditProfileForm, EmptyForm, PostForm, ResetPasswordRequestForm, ResetPasswordForm
 from flask_login import current_user, login_user, logout_user, login_required
 import sqlalchemy as sa
 from app.models import User, Post, Message, Notification
 from urllib.parse import urlsplit
+import json
+from redis.exceptions import RedisError
 from datetime import datetime, timezone
 from app.auth.email import send_password_reset_email
 from flask_babel import get_locale, _
-from langdetect import detect, LangDetectException
 from app.translate import translate
+from app.language import detect_languages_later
 from app.main import bp
+from app.pagination import paginate_view
 from app.main.forms import SearchForm, MessageForm
 
 
@@ -20,24 +24,17 @@ from app.main.forms import SearchForm, MessageForm
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user, language=language)
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
+        post.add_to_timelines()
         db.session.commit()
+        detect_languages_later([post.id])
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = db.paginate(current_user.following_posts(), page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_view(
+        current_user.timeline_posts(), [Post.timestamp, Post.id], 'main.index')
     return render_template('index.html', title='Home', form=form,
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
@@ -53,6 +50,7 @@ def login():
             flash('Invalid username or password')
             return redirect(url_for('main.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()  # saves the password hash if it was upgraded
         next_page = request.args.get('next')
         if not next_page or urlsplit(next_page).netloc != '':
             next_page = url_for('main.index')
@@ -85,25 +83,18 @@ def register():
 @login_required
 def user(username):
     user = db.first_or_404(sa.select(User).where(User.username == username))
-    page = request.args.get('page', 1, type=int)
     query = user.posts.select().order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'],
-                        error_out=False)
-    next_url = url_for('main.user', username=user.username, page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.user', username=user.username, page=posts.prev_num) \
-        if posts.has_prev else None
+    posts, next_url, prev_url = paginate_view(
+        query, [Post.timestamp, Post.id], 'main.user', username=user.username)
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user, posts=posts,
                            next_url=next_url, prev_url=prev_url, form=form)
 
 
 @bp.before_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.now(timezone.utc)
-        db.session.commit()
+        current_app.last_seen_tracker.touch(current_user)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
@@ -170,15 +161,10 @@ def unfollow(username):
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
     query = sa.select(Post).order_by(Post.timestamp.desc())
-    posts = db.paginate(query, page=page,
-                        per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
-    return render_template("index.html", title='Explore', posts=posts.items,
+    posts, next_url, prev_url = paginate_view(
+        query, [Post.timestamp, Post.id], 'main.explore')
+    return render_template("index.html", title='Explore', posts=posts,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -256,6 +242,8 @@ def send_message(recipient):
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
         db.session.add(msg)
+        user.unread_count = User.unread_count + 1
+        db.session.flush()
         user.add_notification('unread_message_count',
                               user.unread_message_count())
         db.session.commit()
@@ -269,19 +257,14 @@ def send_message(recipient):
 @login_required
 def messages():
     current_user.last_message_read_time = datetime.now(timezone.utc)
+    current_user.unread_count = 0
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    page = request.args.get('page', 1, type=int)
     query = current_user.messages_received.select().order_by(
         Message.timestamp.desc())
-    messages = db.paginate(query, page=page,
-                           per_page=current_app.config['POSTS_PER_PAGE'],
-                           error_out=False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    messages, next_url, prev_url = paginate_view(
+        query, [Message.timestamp, Message.id], 'main.messages')
+    return render_template('messages.html', messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -292,11 +275,53 @@ def notifications():
     query = current_user.notifications.select().where(
         Notification.timestamp > since).order_by(Notification.timestamp.asc())
     notifications = db.session.scalars(query)
-    return [{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-    } for n in notifications]
+    return [n.to_dict() for n in notifications]
+
+
+# Server-Sent Events version of /notifications: replays anything newer than
+# Last-Event-ID (a notification timestamp, same as `since` above) and then
+# relays what User.add_notification() publishes through Redis
+@bp.route('/notifications/stream')
+@login_required
+def notification_stream():
+    since = request.headers.get('Last-Event-ID', type=float) or \
+        request.args.get('since', 0.0, type=float)
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(Notification.channel(current_user.id))
+    except RedisError:
+        pubsub.close()
+        abort(503)
+    query = current_user.notifications.select().where(
+        Notification.timestamp > since).order_by(Notification.timestamp.asc())
+    backlog = [n.to_dict() for n in db.session.scalars(query)]
+    heartbeat = current_app.config['NOTIFICATIONS_HEARTBEAT']
+
+    def event(notification):
+        return 'id: {}\ndata: {}\n\n'.format(notification['timestamp'],
+                                             json.dumps(notification))
+
+    def stream():
+        last = since
+        try:
+            for notification in backlog:
+                last = notification['timestamp']
+                yield event(notification)
+            while True:
+                message = pubsub.get_message(timeout=heartbeat)
+                if message is None:
+                    yield ': heartbeat\n\n'
+                    continue
+                notification = json.loads(message['data'])
+                if notification['timestamp'] > last:
+                    last = notification['timestamp']
+                    yield event(notification)
+        finally:
+            pubsub.close()
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @bp.route('/export_posts')
@@ -305,6 +330,7 @@ def export_posts():
     if current_user.get_task_in_progress('export_posts'):
         flash(_('An export task is currently in progress'))
     else:
-        current_user.launch_task('export_posts', _('Exporting posts...'))
+        current_user.launch_task('export_posts', _('Exporting posts...'),
+                                 queue='bulk')
         db.session.commit()
     return redirect(url_for('main.user', username=current_user.username))
\ No newline at end of file
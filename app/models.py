@@ -3,17 +3,20 @@ import sqlalchemy as sa
 import sqlalchemy.orm as so
 from app import db, login
 from datetime import datetime, timezone, timedelta
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from hashlib import md5
 from time import time
 import jwt
-from app.search import add_to_index, remove_from_index, query_index
-from flask import current_app, url_for
+from app.search import query_index, bulk_index, document, create_index, \
+    swap_alias, enqueue_index_ops
+from app.pagination import keyset_paginate
+from flask import current_app, request, url_for
 import json
 import redis
 import rq
 import secrets
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 followers = sa.Table(
@@ -25,15 +28,32 @@ followers = sa.Table(
               primary_key=True)
 )
 
+# placeholder id used to build URL templates with a single url_for() call
+_URL_ID = 9876543210
+
+
+def gravatar_url(digest, size):
+    return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+
 
 # Paginated API mixin for handling pagination in API responses
 class PaginatedAPIMixin(object):
+    # Serialize a page of items; models override this to batch the work
+    @classmethod
+    def to_dict_many(cls, items):
+        return [item.to_dict() for item in items]
+
     @staticmethod
     def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+        model = query.column_descriptions[0]['entity']
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            return PaginatedAPIMixin.to_cursor_collection_dict(
+                query, cursor, per_page, endpoint, **kwargs)
         resources = db.paginate(query, page=page, per_page=per_page,
                                 error_out=False)
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': model.to_dict_many(resources.items),
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -51,6 +71,37 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    # Cursor mode, keyed on the primary key; the total is only counted when
+    # the client asks for it with include_total=1
+    @staticmethod
+    def to_cursor_collection_dict(query, cursor, per_page, endpoint,
+                                  **kwargs):
+        model = query.column_descriptions[0]['entity']
+        include_total = request.args.get('include_total') in ('1', 'true')
+        resources = keyset_paginate(query, [model.id], cursor, per_page,
+                                    descending=False, count=include_total)
+        data = {
+            'items': model.to_dict_many(resources.items),
+            '_meta': {
+                'per_page': per_page,
+                'next_cursor': resources.next_cursor,
+                'prev_cursor': resources.prev_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=resources.next_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_next else None,
+                'prev': url_for(endpoint, cursor=resources.prev_cursor,
+                                per_page=per_page, **kwargs)
+                if resources.has_prev else None
+            }
+        }
+        if include_total:
+            data['_meta']['total_items'] = resources.total
+        return data
+
 
 class User(PaginatedAPIMixin, UserMixin, db.Model):
     # columns
@@ -84,42 +135,64 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     token: so.Mapped[Optional[str]] = so.mapped_column(
         sa.String(32), index=True, unique=True)
     token_expiration: so.Mapped[Optional[datetime]]
+    # denormalized counters, kept in step with follow(), unfollow(), post
+    # inserts/deletes and the message views; `flask counters rebuild`
+    # repairs them
+    post_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                  server_default='0')
+    follower_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                      server_default='0')
+    followed_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                      server_default='0')
+    unread_count: so.Mapped[int] = so.mapped_column(default=0,
+                                                    server_default='0')
     
     # functions
     def __repr__(self):
         return '<User {}>'.format(self.username)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.password_hasher.hash(password)
 
+    # Hashes made with outdated parameters are upgraded on a successful
+    # check; the caller's commit saves the new hash
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        hasher = current_app.password_hasher
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+        return True
     
+    def avatar_hash(self):
+        return md5(self.email.lower().encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return f'https://www.gravatar.com/avatar/{digest}?d=identicon&s={size}'
+        return gravatar_url(self.avatar_hash(), size)
     
     def follow(self, user):
         if not self.is_following(user):
             self.following.add(user)
+            self.followed_count = User.followed_count + 1
+            user.follower_count = User.follower_count + 1
+            self.rebuild_timeline()
 
     def unfollow(self, user):
         if self.is_following(user):
             self.following.remove(user)
+            self.followed_count = User.followed_count - 1
+            user.follower_count = User.follower_count - 1
+            self.rebuild_timeline()
 
     def is_following(self, user):
         query = self.following.select().where(User.id == user.id)
         return db.session.scalar(query) is not None
 
     def followers_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.followers.select().subquery())
-        return db.session.scalar(query)
+        return self.follower_count
 
     def following_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.following.select().subquery())
-        return db.session.scalar(query)
+        return self.followed_count
     
     def following_posts(self):
         Author = so.aliased(User)
@@ -135,6 +208,34 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
             .group_by(Post)
             .order_by(Post.timestamp.desc())
         )
+
+    # Home feed read from the materialized timeline when it is enabled
+    def timeline_posts(self):
+        if not current_app.config['TIMELINE_ENABLED']:
+            return self.following_posts()
+        return (
+            sa.select(Post)
+            .join(TimelineEntry, TimelineEntry.post_id == Post.id)
+            .where(TimelineEntry.user_id == self.id)
+            .order_by(TimelineEntry.timestamp.desc())
+        )
+
+    def rebuild_timeline(self):
+        if not current_app.config['TIMELINE_ENABLED']:
+            return
+        db.session.execute(sa.delete(TimelineEntry).where(
+            TimelineEntry.user_id == self.id))
+        followed = sa.select(followers.c.followed_id).where(
+            followers.c.follower_id == self.id)
+        recent = (
+            sa.select(sa.literal(self.id), Post.id, Post.timestamp)
+            .where(sa.or_(Post.user_id == self.id,
+                          Post.user_id.in_(followed)))
+            .order_by(Post.timestamp.desc())
+            .limit(current_app.config['TIMELINE_LENGTH'])
+        )
+        db.session.execute(sa.insert(TimelineEntry).from_select(
+            ['user_id', 'post_id', 'timestamp'], recent))
     
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -151,23 +252,25 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         return db.session.get(User, id)
     
     def unread_message_count(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        query = sa.select(Message).where(Message.recipient == self,
-                                         Message.timestamp > last_read_time)
-        return db.session.scalar(sa.select(sa.func.count()).select_from(
-            query.subquery()))
+        return self.unread_count
     
     def add_notification(self, name, data):
         db.session.execute(self.notifications.delete().where(
             Notification.name == name))
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=json.dumps(data), user=self,
+                         timestamp=time())
         db.session.add(n)
+        db.session.info.setdefault('notifications', []).append(
+            (self.id, {'name': name, 'data': data, 'timestamp': n.timestamp}))
         return n
     
-    def launch_task(self, name, description, *args, **kwargs):
-        rq_job = current_app.task_queue.enqueue(f'app.tasks.{name}', self.id,
-                                                *args, **kwargs)
-        task = Task(id=rq_job.get_id(), name=name, description=description,
+    # queue is 'high' for short jobs a user waits on, 'default' or 'bulk'
+    # for long running ones that should not hold up the others
+    def launch_task(self, name, description, *args, queue='default',
+                    **kwargs):
+        rq_job = current_app.task_queues[queue].enqueue(
+            f'app.tasks.{name}', self.id, *args, **kwargs)
+        task = Task(id=rq_job.id, name=name, description=description,
                     user=self)
         db.session.add(task)
         return task
@@ -180,32 +283,94 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
         query = self.tasks.select().where(Task.name == name,
                                           Task.complete == False)
         return db.session.scalar(query)
+
+    # Progress of all running tasks as {task_id: percent}, one Redis HGETALL
+    def get_task_progress(self):
+        try:
+            progress = current_app.redis.hgetall(Task.progress_key(self.id))
+        except redis.exceptions.RedisError:
+            return {}
+        return {task_id.decode(): int(value)
+                for task_id, value in progress.items()}
     
     def posts_count(self):
-        query = sa.select(sa.func.count()).select_from(
-            self.posts.select().subquery())
-        return db.session.scalar(query)
+        return self.post_count
+
+    @staticmethod
+    def _counter_queries():
+        return {
+            'post_count': sa.select(sa.func.count(Post.id)).where(
+                Post.user_id == User.id).scalar_subquery(),
+            'follower_count': sa.select(sa.func.count()).select_from(
+                followers).where(
+                followers.c.followed_id == User.id).scalar_subquery(),
+            'followed_count': sa.select(sa.func.count()).select_from(
+                followers).where(
+                followers.c.follower_id == User.id).scalar_subquery(),
+            'unread_count': sa.select(sa.func.count(Message.id)).where(
+                Message.recipient_id == User.id,
+                Message.timestamp > sa.func.coalesce(
+                    User.last_message_read_time, datetime(1900, 1, 1))
+            ).scalar_subquery(),
+        }
+
+    @staticmethod
+    def rebuild_counters():
+        db.session.execute(sa.update(User).values(**User._counter_queries()))
+
+    # Returns (user_id, counter, stored, actual) for every counter that
+    # disagrees with the underlying tables
+    @staticmethod
+    def check_counters():
+        actual = User._counter_queries()
+        query = sa.select(User.id, *[getattr(User, name) for name in actual],
+                          *actual.values()).where(sa.or_(
+                              *[getattr(User, name) != subquery
+                                for name, subquery in actual.items()]))
+        mismatches = []
+        for row in db.session.execute(query):
+            for i, name in enumerate(actual):
+                stored, real = row[1 + i], row[1 + len(actual) + i]
+                if stored != real:
+                    mismatches.append((row[0], name, stored, real))
+        return mismatches
 
     def to_dict(self, include_email=False):
-        data = {
-            'id': self.id,
-            'username': self.username,
-            'last_seen': self.last_seen.replace(
-                tzinfo=timezone.utc).isoformat() if self.last_seen else None,
-            'about_me': self.about_me,
-            'post_count': self.posts_count(),
-            'follower_count': self.followers_count(),
-            'following_count': self.following_count(),
-            '_links': {
-                'self': url_for('api.get_user', id=self.id),
-                'followers': url_for('api.get_followers', id=self.id),
-                'following': url_for('api.get_following', id=self.id),
-                'avatar': self.avatar(128)
-            }
+        return User.to_dict_many([self], include_email=include_email)[0]
+
+    # Serialize a batch of users: counts come from the counter columns and
+    # the link URLs are built once and filled in per user
+    @classmethod
+    def to_dict_many(cls, users, include_email=False):
+        links = {
+            name: url_for(endpoint, id=_URL_ID).replace(str(_URL_ID), '{}')
+            for name, endpoint in [('self', 'api.get_user'),
+                                   ('followers', 'api.get_followers'),
+                                   ('following', 'api.get_following')]
         }
-        if include_email:
-            data['email'] = self.email
-        return data
+        items = []
+        for user in users:
+            data = {
+                'id': user.id,
+                'username': user.username,
+                'last_seen': user.last_seen.replace(
+                    tzinfo=timezone.utc).isoformat()
+                if user.last_seen else None,
+                'about_me': user.about_me,
+                'post_count': user.post_count,
+                'follower_count': user.follower_count,
+                'following_count': user.followed_count,
+                '_links': {
+                    'self': links['self'].format(user.id),
+                    'followers': links['followers'].format(user.id),
+                    'following': links['following'].format(user.id),
+                    'avatar': user.avatar(128)
+                }
+            }
+            if include_email:
+                data['email'] = user.email
+            items.append(data)
+        return items
     
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
@@ -213,12 +378,14 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
                 setattr(self, field, data[field])
         if new_user and 'password' in data:
             self.set_password(data['password'])
+        self._uncache_token()
 
     def get_token(self, expires_in=3600):
         now = datetime.now(timezone.utc)
         if self.token and self.token_expiration.replace(
                 tzinfo=timezone.utc) > now + timedelta(seconds=60):
             return self.token
+        self._uncache_token()
         self.token = secrets.token_hex(16)
         self.token_expiration = now + timedelta(seconds=expires_in)
         db.session.add(self)
@@ -227,59 +394,208 @@ class User(PaginatedAPIMixin, UserMixin, db.Model):
     def revoke_token(self):
         self.token_expiration = datetime.now(timezone.utc) - timedelta(
             seconds=1)
-
+        self._uncache_token()
+
+    # The token leaves this process's cache now and the caches of the other
+    # processes once the change is committed, so they cannot load it again
+    # from the database before the change is visible
+    def _uncache_token(self):
+        if self.token:
+            current_app.token_cache.delete(self.token)
+            db.session.info.setdefault('revoked_tokens', set()).add(
+                self.token)
+
+    # Tokens are cached with the user id until they expire. A cache hit
+    # attaches a stub User to the session without running any SQL; the rest
+    # of its columns are loaded only if the request touches them.
     @staticmethod
     def check_token(token):
+        cached = current_app.token_cache.get(token)
+        if cached is not None:
+            user = User(id=cached[0], token=token, token_expiration=cached[1])
+            so.make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
         user = db.session.scalar(sa.select(User).where(User.token == token))
         if user is None or user.token_expiration.replace(
                 tzinfo=timezone.utc) < datetime.now(timezone.utc):
             return None
+        current_app.token_cache.set(
+            token, (user.id, user.token_expiration),
+            expires_at=user.token_expiration.replace(
+                tzinfo=timezone.utc).timestamp())
         return user
 
-    
+
+def _publish_revoked_tokens(session):
+    for token in session.info.pop('revoked_tokens', ()):
+        current_app.token_cache.revoke(token)
+
+
+def _discard_revoked_tokens(session):
+    session.info.pop('revoked_tokens', None)
+
+db.event.listen(db.session, 'after_commit', _publish_revoked_tokens)
+db.event.listen(db.session, 'after_rollback', _discard_revoked_tokens)
+
 
 class SearchableMixin(object):
+    # Hits that carry a stored document (SEARCH_HYDRATE) are returned as
+    # lightweight result objects; the rest are loaded with one query
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        hits, total = query_index(cls.__tablename__, expression, page,
+                                  per_page, cls.__searchable__)
         if total == 0:
             return [], 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        query = sa.select(cls).where(cls.id.in_(ids)).order_by(
-            db.case(*when, value=cls.id))
-        return db.session.scalars(query), total
-
+        results = {id: cls.from_search_source(id, source)
+                   for id, source in hits if source}
+        missing = [id for id, source in hits if id not in results]
+        if missing:
+            results.update((obj.id, obj) for obj in db.session.scalars(
+                sa.select(cls).where(cls.id.in_(missing))))
+        return [results[id] for id, source in hits if id in results], total
+
+    # Changes are collected after every flush, while ids are assigned and the
+    # values are still loaded, and sent as one bulk request after the commit
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def after_flush(cls, session, flush_context):
+        changes = session.info.setdefault('search_changes', {})
+        for obj in list(session.new) + list(session.dirty):
+            if isinstance(obj, SearchableMixin) and \
+                    session.is_modified(obj, include_collections=False):
+                changes[(obj.__tablename__, obj.id)] = ('index',
+                                                        document(obj))
+        for obj in session.deleted:
+            if isinstance(obj, SearchableMixin):
+                changes[(obj.__tablename__, obj.id)] = ('delete', None)
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        changes = session.info.pop('search_changes', None)
+        if changes:
+            actions = [(op, index, id, payload) for (index, id), (op, payload)
+                       in changes.items()]
+            if current_app.config['SEARCH_ASYNC']:
+                enqueue_index_ops(actions)
+            else:
+                bulk_index(actions)
 
     @classmethod
-    def reindex(cls):
-        for obj in db.session.scalars(sa.select(cls)):
-            add_to_index(cls.__tablename__, obj)
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
+        session.info.pop('search_authors', None)
+
+    # Rebuild the index in primary key chunks, sending each chunk as one bulk
+    # request on a pool of `workers` threads. Progress is saved to the
+    # `checkpoint` file so an interrupted run resumes where it stopped. With
+    # `new_index` the rows go into a fresh index that replaces the live one
+    # atomically once it is complete. If any chunk fails the run stops, the
+    # checkpoint is kept before the first failed chunk and the new index is
+    # not swapped in. If the final pass described below fails after the swap,
+    # the checkpoint is moved to the live index so that the next run indexes
+    # those rows again.
+    #
+    # While a new index is built, live changes still go to the old one. Rows
+    # added in the meantime are picked up by the chunk loop or, once the
+    # index is swapped in, by a final pass over the newest ids; rows edited
+    # or deleted after their chunk was read keep the state they had then.
+    @classmethod
+    def reindex(cls, chunk_size=500, workers=1, checkpoint=None,
+                new_index=False):
+        app = current_app._get_current_object()
+        alias = cls.__tablename__
+        state = {'index': alias, 'last_id': 0}
+        if checkpoint and os.path.exists(checkpoint):
+            with open(checkpoint) as f:
+                state = json.load(f)
+        elif new_index:
+            state['index'] = f'{alias}-{int(time())}'
+            create_index(state['index'])
+
+        def save_checkpoint():
+            if checkpoint:
+                with open(checkpoint + '.tmp', 'w') as f:
+                    json.dump(state, f)
+                os.replace(checkpoint + '.tmp', checkpoint)
+
+        def index_chunk(actions):
+            with app.app_context():
+                return bulk_index(actions)
+
+        indexed = failed = 0
+        finished = {}
+        next_chunk = 0
+
+        def collect(futures):
+            nonlocal failed, next_chunk
+            for future in futures:
+                chunk, last_id = inflight.pop(future)
+                errors = len(future.result())
+                failed += errors
+                if not errors:
+                    finished[chunk] = last_id
+            # only checkpoint past chunks with no failed or unfinished chunk
+            # before them
+            while next_chunk in finished:
+                state['last_id'] = finished.pop(next_chunk)
+                next_chunk += 1
+            save_checkpoint()
+
+        inflight = {}
+        last_id = state['last_id']
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunk = 0
+            while not failed:
+                objs = db.session.scalars(
+                    sa.select(cls).where(cls.id > last_id).order_by(cls.id)
+                    .limit(chunk_size)).all()
+                if not objs:
+                    break
+                last_id = objs[-1].id
+                actions = [('index', state['index'], obj.id, document(obj))
+                           for obj in objs]
+                db.session.expunge_all()
+                inflight[executor.submit(index_chunk, actions)] = \
+                    (chunk, last_id)
+                chunk += 1
+                indexed += len(actions)
+                if len(inflight) >= 2 * workers:
+                    collect(wait(inflight, return_when=FIRST_COMPLETED)[0])
+            collect(list(inflight))
+
+        result = {'index': state['index'], 'indexed': indexed,
+                  'failed': failed, 'swapped': False}
+        if failed:
+            current_app.logger.error(
+                'Reindexing %s into %s stopped after %d failures, resume '
+                'from id %d', alias, state['index'], failed,
+                state['last_id'])
+            return result
+        if state['index'] != alias:
+            swap_alias(alias, state['index'])
+            result['swapped'] = True
+            late = db.session.scalars(sa.select(cls).where(cls.id > last_id)
+                                      .order_by(cls.id)).all()
+            if late:
+                result['indexed'] += len(late)
+                result['failed'] = len(bulk_index(
+                    [('index', alias, obj.id, document(obj))
+                     for obj in late]))
+            if result['failed']:
+                state = {'index': alias, 'last_id': last_id}
+                save_checkpoint()
+                current_app.logger.error(
+                    'Swapped %s in but %d newer rows failed, resume from id '
+                    '%d', alias, result['failed'], last_id)
+                return result
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return result
 
 # Listen for changes to the session and update the search index accordingly
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 
 class Post(SearchableMixin, db.Model):
@@ -295,6 +611,171 @@ class Post(SearchableMixin, db.Model):
     
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+    # Stored in the search index so results render without touching the
+    # database
+    def search_source(self):
+        return {
+            'body': self.body,
+            'timestamp': self.timestamp.isoformat(),
+            'language': self.language,
+            'user_id': self.user_id,
+            'username': self.author.username,
+            'avatar_hash': self.author.avatar_hash()
+        }
+
+    @classmethod
+    def from_search_source(cls, id, source):
+        return PostResult(id, source)
+
+    # Fan-out on write: push the post into the timelines of the author and
+    # their followers, then trim those timelines back to TIMELINE_LENGTH
+    def add_to_timelines(self):
+        if not current_app.config['TIMELINE_ENABLED']:
+            return
+        db.session.flush()
+        post_id = sa.literal(self.id)
+        timestamp = sa.literal(self.timestamp, sa.DateTime)
+        audience = sa.union_all(
+            sa.select(followers.c.follower_id, post_id, timestamp).where(
+                followers.c.followed_id == self.user_id),
+            sa.select(sa.literal(self.user_id), post_id, timestamp),
+        )
+        db.session.execute(sa.insert(TimelineEntry).from_select(
+            ['user_id', 'post_id', 'timestamp'], audience))
+        # the cutoffs are read first, as MySQL cannot delete from a table
+        # that a subquery of the same statement reads
+        readers = sa.union_all(
+            sa.select(followers.c.follower_id.label('user_id')).where(
+                followers.c.followed_id == self.user_id),
+            sa.select(sa.literal(self.user_id).label('user_id')),
+        ).subquery()
+        cutoff = (
+            sa.select(TimelineEntry.timestamp)
+            .where(TimelineEntry.user_id == readers.c.user_id)
+            .order_by(TimelineEntry.timestamp.desc())
+            .offset(current_app.config['TIMELINE_LENGTH'] - 1)
+            .limit(1)
+            .scalar_subquery()
+        )
+        trims = [{'reader': user_id, 'cutoff': timestamp}
+                 for user_id, timestamp in db.session.execute(
+                     sa.select(readers.c.user_id, cutoff))
+                 if timestamp is not None]
+        if trims:
+            timeline = TimelineEntry.__table__
+            db.session.execute(sa.delete(timeline).where(
+                timeline.c.user_id == sa.bindparam('reader'),
+                timeline.c.timestamp < sa.bindparam('cutoff')), trims)
+
+
+def _count_post_insert(mapper, connection, post):
+    connection.execute(sa.update(User).where(User.id == post.user_id).values(
+        post_count=User.post_count + 1))
+
+
+def _count_post_delete(mapper, connection, post):
+    connection.execute(sa.update(User).where(User.id == post.user_id).values(
+        post_count=User.post_count - 1))
+
+# Keep User.post_count in the same transaction as the post itself
+db.event.listen(Post, 'after_insert', _count_post_insert)
+db.event.listen(Post, 'after_delete', _count_post_delete)
+
+
+# A post as stored in the search index, with just what _post.html needs
+class PostResult:
+    __tablename__ = Post.__tablename__
+
+    def __init__(self, id, source):
+        self.id = id
+        self.body = source['body']
+        self.timestamp = datetime.fromisoformat(source['timestamp'])
+        self.language = source['language']
+        self.user_id = source['user_id']
+        self.author = AuthorResult(source['user_id'], source['username'],
+                                   source['avatar_hash'])
+
+    def __repr__(self):
+        return '<PostResult {}>'.format(self.body)
+
+
+class AuthorResult:
+    def __init__(self, id, username, avatar_hash):
+        self.id = id
+        self.username = username
+        self._avatar_hash = avatar_hash
+
+    def avatar(self, size):
+        return gravatar_url(self._avatar_hash, size)
+
+
+# Posts in the search index carry their author's name and avatar, so they are
+# reindexed when those change. Authors are noted while the attribute history
+# is available, and once the change is committed a search worker reindexes
+# their posts; without Redis it is done here, on a session of its own.
+def _note_changed_authors(session, flush_context):
+    if not current_app.config['SEARCH_HYDRATE']:
+        return
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            state = sa.inspect(obj)
+            if state.attrs.username.history.has_changes() or \
+                    state.attrs.email.history.has_changes():
+                session.info.setdefault('search_authors', set()).add(obj.id)
+
+
+def _reindex_changed_authors(session):
+    authors = session.info.pop('search_authors', None)
+    if not authors:
+        return
+    try:
+        current_app.search_queue.enqueue('app.tasks.reindex_author_posts',
+                                         sorted(authors))
+    except redis.exceptions.RedisError:
+        current_app.logger.warning('Could not queue author reindexing',
+                                   exc_info=True)
+        with so.Session(db.engine) as author_session:
+            index_author_posts(authors, author_session)
+
+
+# Index the posts of the given authors in chunks, returning the actions that
+# could not be applied
+def index_author_posts(user_ids, session=None):
+    session = session or db.session
+    chunk_size = current_app.config['SEARCH_INDEX_BATCH']
+    failed = []
+    last_id = 0
+    while True:
+        posts = session.scalars(
+            sa.select(Post).where(Post.user_id.in_(user_ids),
+                                  Post.id > last_id)
+            .order_by(Post.id).limit(chunk_size)).all()
+        if not posts:
+            break
+        last_id = posts[-1].id
+        failed += bulk_index([(
+            'index', post.__tablename__, post.id, document(post))
+            for post in posts])
+        session.expunge_all()
+    return failed
+
+db.event.listen(db.session, 'after_flush', _note_changed_authors)
+db.event.listen(db.session, 'after_commit', _reindex_changed_authors)
+
+
+# Materialized home timeline, one row per (reader, post)
+class TimelineEntry(db.Model):
+    user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id),
+                                               primary_key=True)
+    post_id: so.Mapped[int] = so.mapped_column(
+        sa.ForeignKey(Post.id, ondelete='CASCADE'), primary_key=True)
+    timestamp: so.Mapped[datetime]
+
+    __table_args__ = (
+        sa.Index('ix_timeline_entry_user_id_timestamp', 'user_id',
+                 'timestamp'),
+    )
     
 
 # Load the user from the database for Flask-Login
@@ -334,6 +815,42 @@ class Notification(db.Model):
 
     def get_data(self):
         return json.loads(str(self.payload_json))
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'data': self.get_data(),
+            'timestamp': self.timestamp
+        }
+
+    @staticmethod
+    def channel(user_id):
+        return f'microblog-notifications:{user_id}'
+
+    # Publish the notifications of a committed session so that notification
+    # streams can push them to connected browsers
+    @staticmethod
+    def publish_committed(session):
+        notifications = session.info.pop('notifications', [])
+        if not notifications or \
+                not current_app.config['NOTIFICATIONS_STREAM']:
+            return
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            for user_id, notification in notifications:
+                pipe.publish(Notification.channel(user_id),
+                             json.dumps(notification))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.warning('Could not publish notifications',
+                                       exc_info=True)
+
+    @staticmethod
+    def discard_rolled_back(session):
+        session.info.pop('notifications', None)
+
+db.event.listen(db.session, 'after_commit', Notification.publish_committed)
+db.event.listen(db.session, 'after_rollback', Notification.discard_rolled_back)
     
 
 # Task model for background tasks using RQ - exports posts to a TXT file and emails it to the user
@@ -343,6 +860,7 @@ class Task(db.Model):
     description: so.Mapped[Optional[str]] = so.mapped_column(sa.String(128))
     user_id: so.Mapped[int] = so.mapped_column(sa.ForeignKey(User.id))
     complete: so.Mapped[bool] = so.mapped_column(default=False)
+    progress: so.Mapped[int] = so.mapped_column(default=0, server_default='0')
     user: so.Mapped[User] = so.relationship(back_populates='tasks')
 
     def get_rq_job(self):
@@ -352,8 +870,24 @@ class Task(db.Model):
             return None
         return rq_job
 
-    def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+    @staticmethod
+    def progress_key(user_id):
+        return f'microblog-task-progress:{user_id}'
+
+    # Workers keep the progress of running tasks in one hash per user, which
+    # pages read with User.get_task_progress() instead of fetching each job.
+    # The last progress is also stored on the row, for when the hash entry
+    # has expired.
+    # Given a pipeline, the commands are added to it for the caller to run.
+    def set_progress(self, progress, pipeline=None):
+        key = Task.progress_key(self.user_id)
+        pipe = pipeline or current_app.redis.pipeline()
+        if progress >= 100:
+            pipe.hdel(key, self.id)
+        else:
+            pipe.hset(key, self.id, progress)
+            pipe.expire(key, current_app.config['TASK_PROGRESS_TTL'])
+        if pipeline is None:
+            pipe.execute()
     
 
@@ -0,0 +1,121 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+import sqlalchemy as sa
+from flask import current_app, request, url_for
+from app import db
+
+
+def encode_cursor(values, direction):
+    values = [v.isoformat() if isinstance(v, datetime) else v
+              for v in values]
+    raw = json.dumps([direction, values], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode(
+        'ascii').rstrip('=')
+
+
+# Cursor values come from the client, so each one must be a JSON scalar of
+# the column's type; anything else makes the cursor invalid
+def _cursor_value(column, value):
+    if isinstance(column.type, sa.DateTime):
+        if not isinstance(value, str):
+            raise ValueError(value)
+        return datetime.fromisoformat(value)
+    python_type = column.type.python_type
+    if python_type is float and isinstance(value, int):
+        value = float(value)
+    if isinstance(value, bool) != (python_type is bool) or \
+            not isinstance(value, python_type):
+        raise ValueError(value)
+    return value
+
+
+def decode_cursor(cursor, columns):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        direction, values = json.loads(raw)
+        if direction not in ('next', 'prev') or \
+                not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(cursor)
+        return [_cursor_value(c, v) for c, v in zip(columns, values)], \
+            direction
+    except (binascii.Error, NotImplementedError, TypeError, ValueError):
+        return None, 'next'
+
+
+def _after(columns, values, descending):
+    # row-value comparison (a, b) < (x, y) spelled out so it works everywhere
+    clauses = []
+    for i, column in enumerate(columns):
+        edge = column < values[i] if descending else column > values[i]
+        clauses.append(sa.and_(*[columns[j] == values[j] for j in range(i)],
+                               edge))
+    return sa.or_(*clauses)
+
+
+class KeysetPage:
+    def __init__(self, items, next_cursor, prev_cursor, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.has_next = next_cursor is not None
+        self.has_prev = prev_cursor is not None
+        self.total = total
+
+
+# Cursor pagination keyed on ``columns`` (e.g. timestamp, id): every page
+# costs one indexed range scan, and the total is only counted on request
+def keyset_paginate(query, columns, cursor, per_page, descending=True,
+                    count=False):
+    values, direction = decode_cursor(cursor, columns) if cursor else \
+        (None, 'next')
+    backwards = direction == 'prev'
+    page_query = query.order_by(None)
+    if values is not None:
+        page_query = page_query.where(
+            _after(columns, values, descending != backwards))
+    order = [c.desc() if descending != backwards else c.asc()
+             for c in columns]
+    items = db.session.scalars(
+        page_query.order_by(*order).limit(per_page + 1)).all()
+    more = len(items) > per_page
+    items = items[:per_page]
+    if backwards:
+        items.reverse()
+
+    def key(item):
+        return [getattr(item, c.key) for c in columns]
+
+    next_cursor = prev_cursor = None
+    if items:
+        if more or backwards:
+            next_cursor = encode_cursor(key(items[-1]), 'next')
+        if (more and backwards) or (values is not None and not backwards):
+            prev_cursor = encode_cursor(key(items[0]), 'prev')
+    total = None
+    if count:
+        total = db.session.scalar(sa.select(sa.func.count()).select_from(
+            query.order_by(None).subquery()))
+    return KeysetPage(items, next_cursor, prev_cursor, total)
+
+
+# Paginate a list view, returning the items and the next/prev links. Cursor
+# mode is used when KEYSET_PAGINATION is set or the URL carries a cursor.
+def paginate_view(query, columns, endpoint, **kwargs):
+    per_page = current_app.config['POSTS_PER_PAGE']
+    cursor = request.args.get('cursor')
+    if cursor is not None or current_app.config['KEYSET_PAGINATION']:
+        page = keyset_paginate(query, columns, cursor, per_page)
+        next_url = url_for(endpoint, cursor=page.next_cursor, **kwargs) \
+            if page.has_next else None
+        prev_url = url_for(endpoint, cursor=page.prev_cursor, **kwargs) \
+            if page.has_prev else None
+        return page.items, next_url, prev_url
+    page = request.args.get('page', 1, type=int)
+    items = db.paginate(query, page=page, per_page=per_page, error_out=False)
+    next_url = url_for(endpoint, page=items.next_num, **kwargs) \
+        if items.has_next else None
+    prev_url = url_for(endpoint, page=items.prev_num, **kwargs) \
+        if items.has_prev else None
+    return items.items, next_url, prev_url
@@ -0,0 +1,116 @@
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from flask import current_app
+from redis.exceptions import RedisError
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import generate_password_hash, check_password_hash
+
+# Redis sorted set of the hashes in progress in all processes
+SLOTS_KEY = 'microblog-password-slots'
+
+
+class PasswordPoolBusy(ServiceUnavailable):
+    description = 'Too many sign-in attempts in progress, try again shortly.'
+
+
+# Runs password hashing on a small dedicated thread pool. At most `workers`
+# hashes run at once in a process and `queue_size` more may wait. Across all
+# processes at most `concurrency` hashes run at once, counted in Redis, as a
+# sync gunicorn worker only ever runs one. A request that cannot get a slot
+# within `timeout` seconds fails fast with 503 instead of piling up behind a
+# login storm, and so does one whose hash is not done `hash_timeout` seconds
+# after it got its slot.
+class PasswordHasher:
+    def __init__(self, method, workers=2, queue_size=8, timeout=0.5,
+                 concurrency=None, hash_timeout=5, stale_after=30):
+        self.method = method
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.hash_timeout = hash_timeout
+        self.stale_after = stale_after
+        self._prefixes = {}
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='password')
+
+    # Slots are members of a sorted set scored by when they were taken; the
+    # ones older than `stale_after` belong to processes that died while
+    # hashing and are dropped. Without Redis only the per-process limit
+    # applies.
+    def _acquire_shared(self, deadline):
+        if not self.concurrency:
+            return None
+        slot = secrets.token_hex(8)
+        while True:
+            now = time.time()
+            try:
+                pipe = current_app.redis.pipeline()
+                pipe.zremrangebyscore(SLOTS_KEY, 0, now - self.stale_after)
+                pipe.zadd(SLOTS_KEY, {slot: now})
+                pipe.zrank(SLOTS_KEY, slot)
+                rank = pipe.execute()[-1]
+            except RedisError:
+                current_app.logger.warning(
+                    'Password slots unavailable, using the process limit',
+                    exc_info=True)
+                return None
+            if rank < self.concurrency:
+                return slot
+            self._release_shared(current_app.redis, slot)
+            if time.monotonic() >= deadline:
+                raise PasswordPoolBusy(retry_after=1)
+            time.sleep(0.05)
+
+    def _release_shared(self, redis, slot):
+        if slot is None:
+            return
+        try:
+            redis.zrem(SLOTS_KEY, slot)
+        except RedisError:
+            pass
+
+    def _release(self, redis, slot):
+        self._release_shared(redis, slot)
+        self._slots.release()
+
+    # A hash that times out keeps its slots until it is cancelled or done, so
+    # the limits still count it
+    def _run(self, fn, *args):
+        deadline = time.monotonic() + self.timeout
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordPoolBusy(retry_after=1)
+        redis = current_app.redis
+        try:
+            slot = self._acquire_shared(deadline)
+        except BaseException:
+            self._slots.release()
+            raise
+        future = self._executor.submit(fn, *args)
+        try:
+            result = future.result(timeout=self.hash_timeout)
+        except TimeoutError:
+            future.cancel()
+            future.add_done_callback(lambda f: self._release(redis, slot))
+            raise PasswordPoolBusy(retry_after=1)
+        except BaseException:
+            self._release(redis, slot)
+            raise
+        self._release(redis, slot)
+        return result
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    # werkzeug hashes start with the full method and its parameters, e.g.
+    # "scrypt:32768:8:1$...", also when the method is given as just "scrypt",
+    # so the prefix is taken from a hash made with the current method
+    def needs_rehash(self, password_hash):
+        if self.method not in self._prefixes:
+            self._prefixes[self.method] = generate_password_hash(
+                '', self.method).split('$', 1)[0] + '$'
+        return not password_hash.startswith(self._prefixes[self.method])
@@ -1,25 +1,445 @@
+import json
+import math
+import re
+import time
+from collections import Counter
+from datetime import timedelta
+import sqlalchemy as sa
+from redis.exceptions import RedisError
+from elasticsearch import ApiError, TransportError
 from flask import current_app
+from app import db
+from app.cache import LRUCache
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
+# Redis keys used by asynchronous indexing
+PENDING_OPS_KEY = 'microblog-search-pending'
+DRAIN_SCHEDULED_KEY = 'microblog-search-drain-scheduled'
+LAG_KEY = 'microblog-search-lag'
+GENERATION_KEY = 'microblog-search-generation:{}'
+CHANGED_KEY = 'microblog-search-changed:{}'
+
+# Inverted index used by the local search backend
+search_term = sa.Table(
+    'search_term',
+    db.metadata,
+    sa.Column('index', sa.String(64), primary_key=True),
+    sa.Column('term', sa.String(64), primary_key=True),
+    sa.Column('doc_id', sa.Integer, primary_key=True),
+    sa.Column('tf', sa.Integer, nullable=False),
+    sa.Index('ix_search_term_index_doc_id', 'index', 'doc_id'),
+)
+
+search_document = sa.Table(
+    'search_document',
+    db.metadata,
+    sa.Column('index', sa.String(64), primary_key=True),
+    sa.Column('doc_id', sa.Integer, primary_key=True),
+    sa.Column('length', sa.Integer, nullable=False),
+    sa.Column('source', sa.Text),
+)
+
+# Number and total length of the documents in each local index, for BM25
+search_stats = sa.Table(
+    'search_stats',
+    db.metadata,
+    sa.Column('index', sa.String(64), primary_key=True),
+    sa.Column('documents', sa.Integer, nullable=False),
+    sa.Column('length', sa.Integer, nullable=False),
+)
+
+
+# The indexed fields of a model. With SEARCH_HYDRATE, the fields needed to
+# display the model in search results are stored alongside under 'source'.
+def document(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    #current_app.elasticsearch.index(index=index, id=model.id, document=payload)
+    if current_app.config['SEARCH_HYDRATE']:
+        payload['source'] = model.search_source()
+    return payload
+
+
+def tokenize(text):
+    return [term[:64] for term in re.findall(r'\w+', text.lower())]
+
+
+def _retryable(status):
+    return status == 429 or status >= 500
+
+
+class ElasticsearchBackend:
+    def __init__(self, client):
+        self.client = client
+
+    # Apply the actions with a single _bulk request. Items that fail with a
+    # retryable status (429/5xx) are resent with exponential backoff;
+    # whatever still fails is returned. The changes become searchable at the
+    # next refresh of the index; SearchCache allows for that.
+    def bulk(self, actions):
+        retries = current_app.config['SEARCH_BULK_RETRIES']
+        backoff = current_app.config['SEARCH_BULK_BACKOFF']
+        pending = list(actions)
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            operations = []
+            for op, index, id, payload in pending:
+                operations.append({op: {'_index': index, '_id': id}})
+                if op == 'index':
+                    operations.append(payload)
+            start = time.perf_counter()
+            try:
+                response = self.client.bulk(operations=operations)
+            except (ApiError, TransportError):
+                current_app.logger.warning('Bulk indexing request failed',
+                                           exc_info=True)
+                continue
+            current_app.logger.info(
+                'Bulk indexed %d actions in %.1f ms', len(pending),
+                (time.perf_counter() - start) * 1000)
+            if not response['errors']:
+                return []
+            failed = []
+            for action, item in zip(pending, response['items']):
+                result = item[action[0]]
+                if action[0] == 'delete' and result['status'] == 404:
+                    continue
+                if 'error' in result:
+                    if _retryable(result['status']):
+                        failed.append(action)
+                    else:
+                        current_app.logger.error(
+                            'Could not index %s/%s: %s', action[1],
+                            action[2], result['error'])
+            if not failed:
+                return []
+            pending = failed
+        current_app.logger.error('Gave up indexing %d actions', len(pending))
+        return pending
+
+    def create_index(self, index):
+        self.client.indices.create(index=index, mappings={
+            'properties': {'source': {'type': 'object', 'enabled': False}}})
+
+    def indexed_ids(self, index, ids):
+        response = self.client.mget(index=index, ids=[str(id) for id in ids],
+                                    source=False)
+        return {int(doc['_id']) for doc in response['docs'] if doc['found']}
+
+    # Point `alias` at `index` in one atomic update, dropping whatever the
+    # name referred to before (a previous build or a plain index). The new
+    # index is refreshed first so all of it is searchable once swapped in.
+    def swap_alias(self, alias, index):
+        self.client.indices.refresh(index=index)
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        if self.client.indices.exists_alias(name=alias):
+            for old in self.client.indices.get_alias(name=alias):
+                actions.insert(0, {'remove_index': {'index': old}})
+        elif self.client.indices.exists(index=alias):
+            actions.insert(0, {'remove_index': {'index': alias}})
+        self.client.indices.update_aliases(actions=actions)
+
+    def query(self, index, query, page, per_page, fields):
+        search = self.client.search(
+            index=index,
+            query={'multi_match': {'query': query, 'fields': list(fields)}},
+            source=['source'] if current_app.config['SEARCH_HYDRATE']
+            else False,
+            from_=(page - 1) * per_page,
+            size=per_page)
+        hits = [(int(hit['_id']), hit.get('_source', {}).get('source'))
+                for hit in search['hits']['hits']]
+        return hits, search['hits']['total']['value']
+
+
+# Search without an external cluster: an inverted index kept in the app's
+# own database, ranked with Okapi BM25. Scoring and paging run in SQL; the
+# document count and average length come from search_stats, which bulk()
+# keeps up to date.
+class LocalBackend:
+    k1 = 1.2
+    b = 0.75
+
+    def bulk(self, actions):
+        by_index = {}
+        for op, index, id, payload in actions:
+            by_index.setdefault(index, []).append((id, payload))
+        start = time.perf_counter()
+        with db.engine.begin() as connection:
+            for index, docs in by_index.items():
+                ids = [id for id, payload in docs]
+                removed, removed_length = connection.execute(
+                    sa.select(sa.func.count(),
+                              sa.func.coalesce(
+                                  sa.func.sum(search_document.c.length), 0))
+                    .where(search_document.c.index == index,
+                           search_document.c.doc_id.in_(ids))).one()
+                for table in (search_term, search_document):
+                    connection.execute(table.delete().where(
+                        table.c.index == index, table.c.doc_id.in_(ids)))
+                terms, lengths = [], []
+                for id, payload in docs:
+                    if payload is None:
+                        continue
+                    source = payload.get('source')
+                    tokens = tokenize(' '.join(
+                        str(value) for field, value in payload.items()
+                        if value and field != 'source'))
+                    counts = Counter(tokens)
+                    terms.extend({'index': index, 'term': term,
+                                  'doc_id': id, 'tf': tf}
+                                 for term, tf in counts.items())
+                    lengths.append({
+                        'index': index, 'doc_id': id, 'length': len(tokens),
+                        'source': json.dumps(source) if source else None})
+                if terms:
+                    connection.execute(search_term.insert(), terms)
+                if lengths:
+                    connection.execute(search_document.insert(), lengths)
+                self._update_stats(
+                    connection, index, len(lengths) - removed,
+                    sum(doc['length'] for doc in lengths) - removed_length)
+        current_app.logger.debug(
+            'Locally indexed %d actions in %.1f ms', len(actions),
+            (time.perf_counter() - start) * 1000)
+        return []
+
+    # The stats are adjusted in place; an index without a stats row yet gets
+    # one counted from its documents
+    def _update_stats(self, connection, index, documents, length):
+        result = connection.execute(search_stats.update().where(
+            search_stats.c.index == index).values(
+                documents=search_stats.c.documents + documents,
+                length=search_stats.c.length + length))
+        if result.rowcount == 0:
+            connection.execute(search_stats.insert().from_select(
+                ['index', 'documents', 'length'],
+                sa.select(sa.literal(index), sa.func.count(),
+                          sa.func.coalesce(
+                              sa.func.sum(search_document.c.length), 0))
+                .where(search_document.c.index == index)))
+
+    def create_index(self, index):
+        pass
+
+    def indexed_ids(self, index, ids):
+        return set(db.session.scalars(
+            sa.select(search_document.c.doc_id).where(
+                search_document.c.index == index,
+                search_document.c.doc_id.in_(ids))))
+
+    # Rows are keyed by index name, so the swap is a rename inside one
+    # transaction
+    def swap_alias(self, alias, index):
+        with db.engine.begin() as connection:
+            for table in (search_term, search_document, search_stats):
+                connection.execute(table.delete().where(
+                    table.c.index == alias))
+                connection.execute(table.update().where(
+                    table.c.index == index).values(index=alias))
+
+    def query(self, index, query, page, per_page, fields):
+        terms = set(tokenize(query))
+        if not terms:
+            return [], 0
+        stats = db.session.execute(
+            sa.select(search_stats.c.documents, search_stats.c.length)
+            .where(search_stats.c.index == index)).first()
+        if stats is None or not stats.documents:
+            return [], 0
+        docs, avgdl = stats.documents, stats.length / stats.documents or 1.0
+        matches = sa.and_(search_term.c.index == index,
+                          search_term.c.term.in_(terms))
+        df = dict(db.session.execute(
+            sa.select(search_term.c.term, sa.func.count())
+            .where(matches).group_by(search_term.c.term)).all())
+        if not df:
+            return [], 0
+        idf = {term: math.log(1 + (docs - n + 0.5) / (n + 0.5))
+               for term, n in df.items()}
+        tf = search_term.c.tf
+        norm = self.k1 * (1 - self.b) + \
+            self.k1 * self.b / avgdl * search_document.c.length
+        score = sa.func.sum(sa.case(idf, value=search_term.c.term) * tf *
+                            (self.k1 + 1) / (tf + norm))
+        ids = db.session.scalars(
+            sa.select(search_term.c.doc_id)
+            .join(search_document, sa.and_(
+                search_document.c.index == search_term.c.index,
+                search_document.c.doc_id == search_term.c.doc_id))
+            .where(matches)
+            .group_by(search_term.c.doc_id)
+            .order_by(score.desc(), search_term.c.doc_id.desc())
+            .limit(per_page).offset((page - 1) * per_page)).all()
+        total = db.session.scalar(
+            sa.select(sa.func.count(sa.distinct(search_term.c.doc_id)))
+            .where(matches))
+        sources = {}
+        if ids and current_app.config['SEARCH_HYDRATE']:
+            sources = dict(db.session.execute(
+                sa.select(search_document.c.doc_id, search_document.c.source)
+                .where(search_document.c.index == index,
+                       search_document.c.doc_id.in_(ids))).all())
+        hits = [(id, json.loads(sources[id]) if sources.get(id) else None)
+                for id in ids]
+        return hits, total
+
+
+# Cache of query results. Every change to an index bumps its generation
+# counter, which is part of the cache key, so stale results are never served
+# and simply age out. Generations live in Redis so that changes applied by
+# other processes are seen; a local counter is used if Redis is unavailable.
+# A change is only searchable after the next refresh of the index, up to
+# `refresh_interval` seconds later, so results cached in that window expire
+# when it ends.
+class SearchCache(LRUCache):
+    def __init__(self, *args, refresh_interval=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.refresh_interval = refresh_interval
+        self._generations = {}
+        self._changed = {}
+
+    # The generation of an index and when it last changed
+    def generation(self, index):
+        try:
+            shared, changed = current_app.redis.mget(
+                GENERATION_KEY.format(index), CHANGED_KEY.format(index))
+        except RedisError:
+            shared = changed = None
+        return ((int(shared or 0), self._generations.get(index, 0)),
+                max(float(changed or 0), self._changed.get(index, 0)))
+
+    def bump(self, index):
+        now = time.time()
+        self._generations[index] = self._generations.get(index, 0) + 1
+        self._changed[index] = now
+        try:
+            pipe = current_app.redis.pipeline(transaction=False)
+            pipe.incr(GENERATION_KEY.format(index))
+            pipe.set(CHANGED_KEY.format(index), now)
+            pipe.execute()
+        except RedisError:
+            pass
+
+    # Returns the cache key and when a result stored under it must expire,
+    # None unless the index may not have been refreshed yet
+    def key(self, index, query, page, per_page):
+        generation, changed = self.generation(index)
+        refreshed = changed + self.refresh_interval
+        return (index, ' '.join(query.lower().split()), page, per_page,
+                generation), refreshed if refreshed > time.time() else None
+
+
+def create_backend(app):
+    if app.config['SEARCH_BACKEND'] == 'local':
+        return LocalBackend()
+    if app.config['SEARCH_BACKEND'] == 'elasticsearch' and app.elasticsearch:
+        return ElasticsearchBackend(app.elasticsearch)
+    return None
+
+
+def add_to_index(index, model):
+    bulk_index([('index', index, model.id, document(model))])
+
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    #current_app.elasticsearch.delete(index=index, id=model.id)
+    bulk_index([('delete', index, model.id, None)])
+
+
+# Apply a batch of ('index' | 'delete', index, id, payload) actions, returning
+# the actions that could not be applied
+def bulk_index(actions):
+    if not current_app.search_backend or not actions:
+        return []
+    failed = current_app.search_backend.bulk(actions)
+    for index in {action[1] for action in actions}:
+        current_app.search_cache.bump(index)
+    return failed
+
+
+def create_index(index):
+    if current_app.search_backend:
+        current_app.search_backend.create_index(index)
+
+
+def swap_alias(alias, index):
+    if current_app.search_backend:
+        current_app.search_backend.swap_alias(alias, index)
+        current_app.search_cache.bump(alias)
+
+
+def indexed_ids(index, ids):
+    if not current_app.search_backend:
+        return set(ids)
+    return current_app.search_backend.indexed_ids(index, ids)
+
+
+# Asynchronous indexing: the request only records (index, id, op) in Redis and
+# makes sure a drain job is queued; apply_index_ops() in app/tasks.py reloads
+# the rows and sends them in bulk. Falls back to indexing inline when Redis
+# is unavailable.
+def enqueue_index_ops(actions):
+    now = time.time()
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.rpush(PENDING_OPS_KEY, *[json.dumps([index, id, op, now])
+                                      for op, index, id, payload in actions])
+        pipe.set(DRAIN_SCHEDULED_KEY, 1, nx=True)
+        scheduled = pipe.execute()[-1]
+        if scheduled:
+            current_app.search_queue.enqueue('app.tasks.apply_index_ops')
+    except RedisError:
+        current_app.logger.warning('Could not queue search index changes',
+                                   exc_info=True)
+        bulk_index(actions)
+
+
+# Put ops that could not be applied back on the pending list, to be retried
+# by a drain job in SEARCH_RETRY_DELAY seconds or by the one the next change
+# queues, whichever runs first. `queued_at` keeps the lag measured from the
+# original change.
+def requeue_index_ops(actions, queued_at):
+    pipe = current_app.redis.pipeline()
+    pipe.lpush(PENDING_OPS_KEY, *[json.dumps([index, id, op, queued_at])
+                                  for op, index, id, payload in actions])
+    pipe.set(DRAIN_SCHEDULED_KEY, 1, nx=True)
+    scheduled = pipe.execute()[-1]
+    if scheduled:
+        current_app.search_queue.enqueue_in(
+            timedelta(seconds=current_app.config['SEARCH_RETRY_DELAY']),
+            'app.tasks.apply_index_ops')
+
+
+# Take up to `count` pending ops, keeping only the latest op for each row.
+# Returns {(index, id): op} and the age in seconds of the oldest op taken.
+def pop_index_ops(count):
+    pipe = current_app.redis.pipeline()
+    pipe.delete(DRAIN_SCHEDULED_KEY)
+    pipe.lrange(PENDING_OPS_KEY, 0, count - 1)
+    pipe.ltrim(PENDING_OPS_KEY, count, -1)
+    entries = pipe.execute()[1]
+    ops = {}
+    oldest = None
+    for entry in entries:
+        index, id, op, queued_at = json.loads(entry)
+        ops[(index, id)] = op
+        oldest = queued_at if oldest is None else min(oldest, queued_at)
+    lag = time.time() - oldest if oldest is not None else 0.0
+    if ops:
+        current_app.redis.set(LAG_KEY, lag)
+    return ops, lag
+
 
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+# Returns a page of (id, source) hits and the total number of matches, where
+# source is the stored document when SEARCH_HYDRATE is set and None otherwise
+def query_index(index, query, page, per_page, fields=('*',)):
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        query={'multi_match': {'query': query, 'fields': ['*']}},
-        from_=(page - 1) * per_page,
-        size=per_page)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
\ No newline at end of file
+    key, expires_at = current_app.search_cache.key(index, query, page,
+                                                   per_page)
+    result = current_app.search_cache.get(key)
+    if result is None:
+        result = current_app.search_backend.query(index, query, page,
+                                                  per_page, fields)
+        current_app.search_cache.set(key, result, expires_at)
+    return result
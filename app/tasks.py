@@ -1,10 +1,18 @@
+import gzip
+import tempfile
 import time
 from rq import get_current_job
 from app import create_app, db
-from app.models import Task, User, Post
+from app.models import Task, User, Post, SearchableMixin, index_author_posts
+from app.search import bulk_index, document, pop_index_ops, \
+    requeue_index_ops
+from app.pagination import keyset_paginate
+from app.language import detect_post_languages  # noqa: F401 (queued job)
+from app.translate import pretranslate_posts  # noqa: F401 (queued job)
+import sqlalchemy as sa
 import sys
 import json
-from flask import render_template
+from flask import render_template, current_app, has_app_context
 from app.email import send_email
 
 def example(seconds):
@@ -19,50 +27,164 @@ def example(seconds):
     job.save_meta()
     print('Task completed')
 
-app = create_app()
-app.app_context().push()
+# `flask worker` imports this module with the application already loaded;
+# a plain `rq worker` needs to create its own
+if has_app_context():
+    app = current_app._get_current_object()
+else:
+    app = create_app()
+    app.app_context().push()
 
 
+# The job meta and the user's progress hash are written to Redis in one
+# round trip, and the notification and completion flag in one commit
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
         job.meta['progress'] = progress
-        job.save_meta()
-        task = db.session.get(Task, job.get_id())
-        task.user.add_notification('task_progress', {'task_id': job.get_id(),
+        task = db.session.get(Task, job.id)
+        pipe = job.connection.pipeline()
+        pipe.hset(job.key, 'meta', job.serializer.dumps(job.meta))
+        task.set_progress(progress, pipe)
+        pipe.execute()
+        task.user.add_notification('task_progress', {'task_id': job.id,
                                                      'progress': progress})
+        task.progress = progress
         if progress >= 100:
             task.complete = True
         db.session.commit()
 
 
+# Throttles progress updates for long running tasks: progress is only
+# recorded once it has moved by `min_delta` percent or `interval` seconds
+# have passed since the last report, and completion is always recorded.
+# Each report goes through _set_task_progress().
+class ProgressReporter:
+    def __init__(self, min_delta=None, interval=None):
+        self.min_delta = app.config['TASK_PROGRESS_DELTA'] \
+            if min_delta is None else min_delta
+        self.interval = app.config['TASK_PROGRESS_INTERVAL'] \
+            if interval is None else interval
+        self.reported = None
+        self._last_report = 0.0
+
+    def update(self, progress):
+        now = time.monotonic()
+        if progress == self.reported:
+            return False
+        if self.reported is not None and progress < 100 and \
+                progress - self.reported < self.min_delta and \
+                now - self._last_report < self.interval:
+            return False
+        self.reported = progress
+        self._last_report = now
+        _set_task_progress(progress)
+        return True
+
+    def finish(self):
+        self.update(100)
+
+
+# Export a user's posts as gzipped JSON Lines. Posts are read in keyset
+# chunks and written straight to a spool file, so memory use does not grow
+# with the number of posts.
 def export_posts(user_id):
+    progress = ProgressReporter()
     try:
         user = db.session.get(User, user_id)
-        _set_task_progress(0)
-        data = []
-        i = 0
-        total_posts = db.session.scalar(sa.select(sa.func.count()).select_from(
-            user.posts.select().subquery()))
-        for post in db.session.scalars(user.posts.select().order_by(
-                Post.timestamp.asc())):
-            data.append({'body': post.body,
-                         'timestamp': post.timestamp.isoformat() + 'Z'})
-            time.sleep(5)
-            i += 1
-            _set_task_progress(100 * i // total_posts)
+        progress.update(0)
+        total_posts = user.post_count
+        exported = 0
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as spool:
+            with gzip.open(spool, 'wt', encoding='utf-8') as f:
+                cursor = None
+                while True:
+                    page = keyset_paginate(
+                        user.posts.select(), [Post.timestamp, Post.id],
+                        cursor, app.config['EXPORT_CHUNK_SIZE'],
+                        descending=False)
+                    for post in page.items:
+                        f.write(json.dumps({
+                            'body': post.body,
+                            'timestamp': post.timestamp.isoformat() + 'Z'
+                        }) + '\n')
+                    exported += len(page.items)
+                    if not page.has_next:
+                        break
+                    cursor = page.next_cursor
+                    progress.update(
+                        min(99, 100 * exported // max(total_posts, 1)))
+            elapsed = time.perf_counter() - start
+            app.logger.info('Exported %d posts for user %d in %.1fs '
+                            '(%.0f posts/s, %d bytes)', exported, user_id,
+                            elapsed, exported / elapsed if elapsed else 0,
+                            spool.tell())
+            spool.seek(0)
+            # the archive is attached from memory: flask-mail builds the
+            # whole message, base64 encoded, before handing it to smtplib,
+            # so the compressed export (a third or less of the JSON) must
+            # fit in the worker's memory
+            send_email(
+                '[Microblog] Your blog posts',
+                sender=app.config['ADMINS'][0], recipients=[user.email],
+                text_body=render_template('email/export_posts.txt',
+                                          user=user),
+                html_body=render_template('email/export_posts.html',
+                                          user=user),
+                attachments=[('posts.jsonl.gz', 'application/gzip',
+                              spool.read())],
+                sync=True)
 
-        send_email(
-            '[Microblog] Your blog posts',
-            sender=app.config['ADMINS'][0], recipients=[user.email],
-            text_body=render_template('email/export_posts.txt', user=user),
-            html_body=render_template('email/export_posts.html', user=user),
-            attachments=[('posts.json', 'application/json',
-                          json.dumps({'posts': data}, indent=4))],
-            sync=True)
-        
     except Exception:
-        _set_task_progress(100)
+        db.session.rollback()
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
-        _set_task_progress(100)
\ No newline at end of file
+        progress.finish()
+
+
+# Drain the asynchronous search queue: pending ops are coalesced per row and
+# each row is indexed from its current state, or deleted if it is gone. Ops
+# that fail are put back on the queue and the drain stops until the retry.
+def apply_index_ops():
+    models = {cls.__tablename__: cls
+              for cls in SearchableMixin.__subclasses__()}
+    while True:
+        ops, lag = pop_index_ops(app.config['SEARCH_INDEX_BATCH'])
+        if not ops:
+            break
+        app.logger.info('Applying %d search index changes, lag %.1fs',
+                        len(ops), lag)
+        ids = {}
+        for index, id in ops:
+            ids.setdefault(index, []).append(id)
+        actions = []
+        for index, index_ids in ids.items():
+            model = models[index]
+            rows = {obj.id: obj for obj in db.session.scalars(
+                sa.select(model).where(model.id.in_(index_ids)))}
+            for id in index_ids:
+                if id in rows:
+                    actions.append(('index', index, id, document(rows[id])))
+                else:
+                    actions.append(('delete', index, id, None))
+        db.session.remove()
+        try:
+            failed = bulk_index(actions)
+        except Exception:
+            requeue_index_ops(actions, time.time() - lag)
+            raise
+        if failed:
+            app.logger.warning('Requeued %d search index changes that '
+                               'failed', len(failed))
+            requeue_index_ops(failed, time.time() - lag)
+            break
+
+
+# Reindex the posts of authors whose name or avatar changed; changes that
+# fail are retried through the asynchronous index queue
+def reindex_author_posts(user_ids):
+    failed = index_author_posts(user_ids)
+    db.session.remove()
+    if failed:
+        requeue_index_ops(failed, time.time())
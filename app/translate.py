@@ -1,19 +1,263 @@
+import hashlib
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone, timedelta
+from time import time, monotonic
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import sqlalchemy as sa
 from flask_babel import _
 from flask import current_app
+from app import db
+from app.models import Post
+from app.language import UNDETERMINED
+
+# Translations already paid for, shared by all processes; an in-process LRU
+# cache (app.translation_cache) sits in front of it
+translation_cache = sa.Table(
+    'translation_cache',
+    db.metadata,
+    sa.Column('text_hash', sa.String(64), primary_key=True),
+    sa.Column('source', sa.String(5), primary_key=True),
+    sa.Column('dest', sa.String(5), primary_key=True),
+    sa.Column('translation', sa.Text, nullable=False),
+    sa.Column('created_at', sa.Float, nullable=False, index=True),
+)
+
+
+# Shared client for outbound HTTP integrations: one keep-alive Session with a
+# connection pool, connect/read timeouts, at most `concurrency` requests in
+# flight and a circuit breaker. After `failure_threshold` consecutive
+# failures the circuit opens and requests fail immediately for
+# `reset_timeout` seconds; then one trial request decides whether it closes.
+# post() returns the response, or None when the request failed or was not
+# attempted.
+class HTTPClient:
+    def __init__(self, concurrency=10, timeout=(3.05, 10), retries=2,
+                 failure_threshold=5, reset_timeout=30, name='http'):
+        self.name = name
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self.session = requests.Session()
+        # Retry-After is ignored: the translator can ask for minutes, and
+        # the request would hold a worker and a slot for all of them
+        retry = Retry(total=retries, read=0, backoff_factor=0.2,
+                      status_forcelist=(429, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False,
+                      respect_retry_after_header=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency,
+                              max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if monotonic() - self.opened_at < self.reset_timeout or \
+                    self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def _record(self, ok):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.opened_at is not None or \
+                    self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    current_app.logger.warning(
+                        '%s circuit opened after %d failures', self.name,
+                        self.failures)
+                self.opened_at = monotonic()
+
+    def post(self, url, **kwargs):
+        if not self._allow():
+            return None
+        if not self._slots.acquire(timeout=self.timeout[0]):
+            with self._lock:
+                self._trial = False
+            return None
+        try:
+            r = self.session.post(url, timeout=self.timeout, **kwargs)
+        except requests.RequestException:
+            current_app.logger.warning('%s request failed', self.name,
+                                       exc_info=True)
+            self._record(False)
+            return None
+        finally:
+            self._slots.release()
+        # being throttled counts as a failure, so the circuit opens and
+        # backs off instead of retrying every call
+        self._record(r.status_code < 500 and r.status_code != 429)
+        return r
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
 
 def translate(text, source_language, dest_language):
+    return translate_batch([text], source_language, dest_language)[0]
+
+
+# Translate several texts with the same source and destination. Cached
+# translations are used where available and the rest are sent to the
+# translator in requests of up to TRANSLATOR_BATCH_SIZE texts. Failed texts
+# get the error message in their place and are not cached.
+def translate_batch(texts, source_language, dest_language):
     if 'MS_TRANSLATOR_KEY' not in current_app.config or \
             not current_app.config['MS_TRANSLATOR_KEY']:
-        return _('Error: the translation service is not configured.')
+        return [_('Error: the translation service is not configured.')] * \
+            len(texts)
+    return _translate_batch(texts, source_language, dest_language)[0]
+
+
+# translate_batch() for a configured translator, also returning the number of
+# translations it added to the cache
+def _translate_batch(texts, source_language, dest_language):
+    hashes = [text_hash(text) for text in texts]
+    cached = _cached_translations(set(hashes), source_language,
+                                  dest_language)
+    missing = {}
+    for text, hash in zip(texts, hashes):
+        if hash not in cached:
+            missing.setdefault(hash, text)
+    translated = {}
+    batch_size = current_app.config['TRANSLATOR_BATCH_SIZE']
+    pending = list(missing.items())
+    for i in range(0, len(pending), batch_size):
+        chunk = pending[i:i + batch_size]
+        results = _request_translations([text for hash, text in chunk],
+                                        source_language, dest_language)
+        if results is not None:
+            translated.update(zip([hash for hash, text in chunk], results))
+    stored = 0
+    if translated:
+        stored = _store_translations(translated, source_language,
+                                     dest_language)
+    cached.update(translated)
+    error = _('Error: the translation service failed.')
+    return [cached.get(hash, error) for hash in hashes], stored
+
+
+def _cached_translations(hashes, source_language, dest_language):
+    cache = current_app.translation_cache
+    found = {}
+    for hash in hashes:
+        translation = cache.get((hash, source_language, dest_language))
+        if translation is not None:
+            found[hash] = translation
+    hashes = hashes - found.keys()
+    if hashes:
+        rows = db.session.execute(
+            sa.select(translation_cache.c.text_hash,
+                      translation_cache.c.translation)
+            .where(translation_cache.c.text_hash.in_(hashes),
+                   translation_cache.c.source == source_language,
+                   translation_cache.c.dest == dest_language,
+                   translation_cache.c.created_at >
+                   time() - current_app.config['TRANSLATION_CACHE_TTL']))
+        for hash, translation in rows:
+            cache.set((hash, source_language, dest_language), translation)
+            found[hash] = translation
+    return found
+
+
+# Replaces expired copies of the translations. Another process may store
+# some of the same texts between the delete and the insert; theirs is as
+# good as ours, so the rows that collide are skipped. Returns the number of
+# rows stored.
+def _store_translations(translations, source_language, dest_language):
+    now = time()
+    rows = [{'text_hash': hash, 'source': source_language,
+             'dest': dest_language, 'translation': translation,
+             'created_at': now}
+            for hash, translation in translations.items()]
+    with db.engine.begin() as connection:
+        connection.execute(translation_cache.delete().where(
+            translation_cache.c.text_hash.in_(translations),
+            translation_cache.c.source == source_language,
+            translation_cache.c.dest == dest_language))
+    stored = len(rows)
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(translation_cache.insert(), rows)
+    except sa.exc.IntegrityError:
+        for row in rows:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(translation_cache.insert(), row)
+            except sa.exc.IntegrityError:
+                stored -= 1
+    for hash, translation in translations.items():
+        current_app.translation_cache.set(
+            (hash, source_language, dest_language), translation)
+    return stored
+
+
+# One translator request for a list of texts, returning the translations in
+# the same order or None if the request failed
+def _request_translations(texts, source_language, dest_language):
     auth = {
         'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': 'westus',
     }
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
+    r = current_app.translator.post(
+        current_app.config['MS_TRANSLATOR_URL'] +
         '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[{'Text': text}])
-    if r.status_code != 200:
-        return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
\ No newline at end of file
+            source_language, dest_language), headers=auth,
+        json=[{'Text': text} for text in texts])
+    if r is None or r.status_code != 200:
+        return None
+    return [item['translations'][0]['text'] for item in r.json()]
+
+
+# Delete cached translations older than TRANSLATION_CACHE_TTL
+def prune_translations():
+    with db.engine.begin() as connection:
+        result = connection.execute(translation_cache.delete().where(
+            translation_cache.c.created_at <
+            time() - current_app.config['TRANSLATION_CACHE_TTL']))
+    return result.rowcount
+
+
+# Translate the most recent posts of the last `hours` hours, the ones
+# /explore shows first, into every other language in LANGUAGES, so that
+# clicking "Translate" on them is answered from the translation cache.
+# Translations that are already cached cost nothing, so running this on a
+# schedule only translates the posts that are new since the last run.
+# Returns the number of translations added to the cache.
+def pretranslate_posts(limit=None, hours=None):
+    if not current_app.config.get('MS_TRANSLATOR_KEY'):
+        return 0
+    limit = limit or current_app.config['PRETRANSLATE_POSTS']
+    hours = hours or current_app.config['PRETRANSLATE_WINDOW']
+    since = datetime.now(timezone.utc) - timedelta(hours=hours)
+    rows = db.session.execute(
+        sa.select(Post.body, Post.language)
+        .where(Post.timestamp > since, Post.language.is_not(None),
+               Post.language.not_in(['', UNDETERMINED]))
+        .order_by(Post.timestamp.desc()).limit(limit))
+    texts = defaultdict(list)
+    for body, language in rows:
+        texts[language].append(body)
+    translated = 0
+    for source_language, bodies in texts.items():
+        for dest_language in current_app.config['LANGUAGES']:
+            if dest_language != source_language:
+                translated += _translate_batch(bodies, source_language,
+                                               dest_language)[1]
+    return translated
@@ -0,0 +1,63 @@
+import os
+import time
+from datetime import timezone
+import rq
+from rq.utils import now
+from rq.worker_pool import WorkerPool
+from flask import current_app
+from app import db
+from app.language import warm_detector
+
+# Redis hash of queue name -> seconds the last job started waited in it
+QUEUE_LATENCY_KEY = 'microblog-queue-latency'
+
+# Queues consumed by `flask worker`, highest priority first
+WORKER_QUEUES = ['high', 'default', 'search', 'bulk']
+
+
+def worker_queues():
+    return dict(current_app.task_queues, search=current_app.search_queue)
+
+
+# RQ worker that logs how long each job waited and how many jobs are still
+# queued behind it, and records the wait per queue for `flask queues`
+class Worker(rq.Worker):
+    def execute_job(self, job, queue):
+        enqueued_at = job.enqueued_at or now()
+        if enqueued_at.tzinfo is None:
+            enqueued_at = enqueued_at.replace(tzinfo=timezone.utc)
+        latency = (now() - enqueued_at).total_seconds()
+        self.connection.hset(QUEUE_LATENCY_KEY, queue.name, latency)
+        self.log.info('%s: %s waited %.1fs, %d jobs queued', queue.name,
+                      job.func_name, latency, queue.count)
+        start = time.perf_counter()
+        super().execute_job(job, queue)
+        self.log.info('%s: %s finished in %.1fs', queue.name, job.func_name,
+                      time.perf_counter() - start)
+
+
+# Load the application, the task module and the language profiles once,
+# then fork `processes` workers that share them. Each forked process
+# (workers and the work horses they fork for every job) drops the database
+# connections inherited from its parent without closing them, so the
+# parent's sockets stay usable. Workers also run RQ's scheduler, which queues
+# the delayed search index retries.
+def run_workers(queues, processes=1, burst=False):
+    import app.tasks  # noqa: F401
+
+    warm_detector()
+    engines = list(db.engines.values())
+
+    def reset_connections():
+        for engine in engines:
+            engine.dispose(close=False)
+
+    os.register_at_fork(after_in_child=reset_connections)
+    names = [worker_queues()[name].name for name in queues]
+    if processes > 1:
+        pool = WorkerPool(names, connection=current_app.redis,
+                          num_workers=processes, worker_class=Worker)
+        pool.start(burst=burst)
+    else:
+        worker = Worker(names, connection=current_app.redis)
+        worker.work(burst=burst, with_scheduler=True)
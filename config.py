@@ -14,10 +14,81 @@ class Config:
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME')
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
+    MAIL_WORKERS = int(os.environ.get('MAIL_WORKERS') or 2)
+    MAIL_QUEUE_SIZE = int(os.environ.get('MAIL_QUEUE_SIZE') or 1000)
+    MAIL_BATCH_SIZE = int(os.environ.get('MAIL_BATCH_SIZE') or 20)
+    MAIL_RETRIES = int(os.environ.get('MAIL_RETRIES') or 3)
+    MAIL_BACKOFF = float(os.environ.get('MAIL_BACKOFF') or 1.0)
+    MAIL_IDLE_TIMEOUT = int(os.environ.get('MAIL_IDLE_TIMEOUT') or 30)
+    MAIL_FLUSH_TIMEOUT = int(os.environ.get('MAIL_FLUSH_TIMEOUT') or 10)
     ADMINS = ['your-email@example.com']
     POSTS_PER_PAGE = 25
+    KEYSET_PAGINATION = os.environ.get('KEYSET_PAGINATION') is not None
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    LANGUAGE_MIN_LENGTH = int(os.environ.get('LANGUAGE_MIN_LENGTH') or 10)
+    TRANSLATOR_CONNECT_TIMEOUT = float(
+        os.environ.get('TRANSLATOR_CONNECT_TIMEOUT') or 3.05)
+    TRANSLATOR_READ_TIMEOUT = float(
+        os.environ.get('TRANSLATOR_READ_TIMEOUT') or 10)
+    TRANSLATOR_CONCURRENCY = int(
+        os.environ.get('TRANSLATOR_CONCURRENCY') or 10)
+    TRANSLATOR_RETRIES = int(os.environ.get('TRANSLATOR_RETRIES') or 2)
+    TRANSLATOR_FAILURE_THRESHOLD = int(
+        os.environ.get('TRANSLATOR_FAILURE_THRESHOLD') or 5)
+    TRANSLATOR_RESET_TIMEOUT = int(
+        os.environ.get('TRANSLATOR_RESET_TIMEOUT') or 30)
+    TRANSLATOR_BATCH_SIZE = int(os.environ.get('TRANSLATOR_BATCH_SIZE') or 100)
+    TRANSLATION_CACHE_SIZE = int(
+        os.environ.get('TRANSLATION_CACHE_SIZE') or 10000)
+    TRANSLATION_CACHE_TTL = int(
+        os.environ.get('TRANSLATION_CACHE_TTL') or 30 * 24 * 3600)
+    PRETRANSLATE_POSTS = int(os.environ.get('PRETRANSLATE_POSTS') or 200)
+    PRETRANSLATE_WINDOW = int(os.environ.get('PRETRANSLATE_WINDOW') or 24)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND') or \
+        ('elasticsearch' if ELASTICSEARCH_URL else 'local')
+    SEARCH_ASYNC = os.environ.get('SEARCH_ASYNC') is not None
+    SEARCH_INDEX_BATCH = int(os.environ.get('SEARCH_INDEX_BATCH') or 500)
+    SEARCH_RETRY_DELAY = int(os.environ.get('SEARCH_RETRY_DELAY') or 30)
+    SEARCH_HYDRATE = os.environ.get('SEARCH_HYDRATE') is not None
+    SEARCH_CACHE_SIZE = int(os.environ.get('SEARCH_CACHE_SIZE') or 1000)
+    SEARCH_CACHE_TTL = int(os.environ.get('SEARCH_CACHE_TTL') or 300)
+    SEARCH_REFRESH_INTERVAL = float(
+        os.environ.get('SEARCH_REFRESH_INTERVAL') or 1)
+    SEARCH_CACHE_REPORT_EVERY = int(
+        os.environ.get('SEARCH_CACHE_REPORT_EVERY') or 1000)
+    SEARCH_BULK_RETRIES = int(os.environ.get('SEARCH_BULK_RETRIES') or 3)
+    SEARCH_BULK_BACKOFF = float(os.environ.get('SEARCH_BULK_BACKOFF') or 0.5)
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
-    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
\ No newline at end of file
+    REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    LAST_SEEN_GRANULARITY = int(os.environ.get('LAST_SEEN_GRANULARITY') or 60)
+    LAST_SEEN_FLUSH_INTERVAL = int(
+        os.environ.get('LAST_SEEN_FLUSH_INTERVAL') or 30)
+    NOTIFICATIONS_STREAM = os.environ.get('NOTIFICATIONS_STREAM') is not None
+    NOTIFICATIONS_HEARTBEAT = int(
+        os.environ.get('NOTIFICATIONS_HEARTBEAT') or 15)
+    TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE') or 1024)
+    TOKEN_CACHE_TTL = int(os.environ.get('TOKEN_CACHE_TTL') or 300)
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD') or \
+        'scrypt:32768:8:1'
+    PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS') or 2)
+    PASSWORD_QUEUE_SIZE = int(os.environ.get('PASSWORD_QUEUE_SIZE') or 8)
+    PASSWORD_QUEUE_TIMEOUT = float(
+        os.environ.get('PASSWORD_QUEUE_TIMEOUT') or 0.5)
+    PASSWORD_CONCURRENCY = int(os.environ.get('PASSWORD_CONCURRENCY') or 8)
+    PASSWORD_HASH_TIMEOUT = float(
+        os.environ.get('PASSWORD_HASH_TIMEOUT') or 5)
+    FRAGMENT_CACHE_SIZE = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 5000)
+    FRAGMENT_CACHE_TTL = int(os.environ.get('FRAGMENT_CACHE_TTL') or 3600)
+    FRAGMENT_CACHE_REPORT_EVERY = int(
+        os.environ.get('FRAGMENT_CACHE_REPORT_EVERY') or 10000)
+    EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE') or 1000)
+    TASK_PROGRESS_DELTA = int(os.environ.get('TASK_PROGRESS_DELTA') or 5)
+    TASK_PROGRESS_INTERVAL = float(
+        os.environ.get('TASK_PROGRESS_INTERVAL') or 2)
+    TASK_PROGRESS_TTL = int(os.environ.get('TASK_PROGRESS_TTL') or 86400)
+    TIMELINE_ENABLED = os.environ.get('TIMELINE_ENABLED') is not None
+    TIMELINE_LENGTH = int(os.environ.get('TIMELINE_LENGTH') or 800)
@@ -2,14 +2,182 @@ import os
 os.environ['DATABASE_URL'] = 'sqlite://'
 
 from datetime import datetime, timezone, timedelta
+import base64
+import gzip
+import json
+import socket
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import redis
+import rq
+import sqlalchemy as sa
+from elasticsearch import ConnectionError as ElasticConnectionError
+from flask import g
 from app import create_app, db
-from app.models import User, Post
+from app.cache import TokenCache, TOKEN_REVOKED_CHANNEL
+from app.models import User, Post, PostResult, Message, Notification, Task
+from app.pagination import keyset_paginate
+from app.activity import LastSeenTracker
+from app.fragments import FragmentCache, render_posts
+from app.worker import Worker, QUEUE_LATENCY_KEY, WORKER_QUEUES
+from app.passwords import PasswordHasher, PasswordPoolBusy
+from app.language import detect_language, detect_languages_later, \
+    detect_post_languages
+from app.search import ElasticsearchBackend, LocalBackend, PENDING_OPS_KEY, \
+    search_term, search_document, search_stats, SearchCache
+from app.email import MailDispatcher, send_email
+from app.translate import HTTPClient, translate, translate_batch, \
+    pretranslate_posts, translation_cache, text_hash, _store_translations
+from aiosmtpd.controller import Controller
 from config import Config
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    PASSWORD_CONCURRENCY = 0
+
+
+class SMTPRecorder:
+    def __init__(self):
+        self.connections = 0
+        self.messages = []
+
+    async def handle_EHLO(self, server, session, envelope, hostname,
+                          responses):
+        self.connections += 1
+        session.host_name = hostname
+        return responses
+
+    async def handle_DATA(self, server, session, envelope):
+        self.messages.append(envelope)
+        return '250 OK'
+
+
+# Stand-in for the translator API: "translates" by upper-casing the texts
+class TranslatorStub(BaseHTTPRequestHandler):
+    requests = []
+    status = 200
+    delay = 0
+    retry_after = None
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        TranslatorStub.requests.append(body)
+        time.sleep(TranslatorStub.delay)
+        if TranslatorStub.status != 200:
+            self.send_response(TranslatorStub.status)
+            if TranslatorStub.retry_after is not None:
+                self.send_header('Retry-After', TranslatorStub.retry_after)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        payload = json.dumps([
+            {'translations': [{'text': item['Text'].upper()}]}
+            for item in body]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Local search backend whose bulk requests fail on the given calls
+class FlakyBackend(LocalBackend):
+    def __init__(self, fail=()):
+        self.fail = list(fail)
+        self.calls = 0
+
+    def bulk(self, actions):
+        self.calls += 1
+        if self.calls in self.fail:
+            return list(actions)
+        return super().bulk(actions)
+
+
+# In-process stand-in for the few Redis commands the caches use
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys, *args):
+        keys = list(keys) if isinstance(keys, list) else [keys, *args]
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def delete(self, *keys):
+        return sum(self.data.pop(key, None) is not None for key in keys)
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+        return len(self.data[key])
+
+    def lpush(self, key, *values):
+        self.data[key] = list(reversed(values)) + self.data.get(key, [])
+        return len(self.data[key])
+
+    def lrange(self, key, start, end):
+        values = self.data.get(key, [])
+        return values[start:end + 1 if end != -1 else None]
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.lrange(key, start, end)
+        return True
+
+    def llen(self, key):
+        return len(self.data.get(key, []))
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[str(field).encode()] = \
+            str(value).encode()
+        return 1
+
+    def hdel(self, key, *fields):
+        hash = self.data.get(key, {})
+        return sum(hash.pop(str(field).encode(), None) is not None
+                   for field in fields)
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append(
+            (name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.redis, name)(*args, **kwargs)
+                for name, args, kwargs in self.commands]
 
 
 class UserModelCase(unittest.TestCase):
@@ -30,6 +198,62 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
 
+    def test_password_rehash(self):
+        self.app.config['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'
+        self.app.password_hasher.method = 'pbkdf2:sha256:1000'
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.app.password_hasher.method = 'pbkdf2:sha256:2000'
+        self.assertFalse(u.check_password('dog'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:2000$'))
+        self.assertTrue(u.check_password('cat'))
+
+    def test_password_limits(self):
+        hasher = PasswordHasher('pbkdf2', timeout=0.1)
+        self.assertFalse(hasher.needs_rehash(hasher.hash('cat')))
+        self.assertTrue(hasher.needs_rehash(
+            PasswordHasher('pbkdf2:sha256:1000').hash('cat')))
+
+        # a request stops waiting for a slow hash after hash_timeout
+        hasher = PasswordHasher('pbkdf2:sha256:1000', workers=1,
+                                queue_size=0, timeout=0.1, hash_timeout=0.1)
+        start = time.monotonic()
+        with self.assertRaises(PasswordPoolBusy):
+            hasher._run(time.sleep, 0.5)
+        self.assertLess(time.monotonic() - start, 0.3)
+        # the slow hash keeps its slot until it is done
+        with self.assertRaises(PasswordPoolBusy):
+            hasher.hash('cat')
+        time.sleep(0.5)
+        self.assertFalse(hasher.needs_rehash(hasher.hash('cat')))
+
+        # hashes in progress are limited across processes through Redis
+        u = User(username='susan', email='susan@example.com')
+        u.set_password('cat')
+        db.session.add(u)
+        db.session.commit()
+        self.app.redis = mock.MagicMock()
+        pipe = self.app.redis.pipeline.return_value
+        self.app.password_hasher = PasswordHasher(
+            self.app.config['PASSWORD_HASH_METHOD'], timeout=0.1,
+            concurrency=1)
+        client = self.app.test_client()
+        auth = {'Authorization': 'Basic ' + base64.b64encode(
+            b'susan:cat').decode()}
+        pipe.execute.return_value = [0, 1, 1]
+        rv = client.post('/api/tokens', headers=auth)
+        self.assertEqual(rv.status_code, 503)
+        self.assertEqual(rv.headers['Retry-After'], '1')
+        self.assertEqual(rv.get_json()['error'], 'Service Unavailable')
+        pipe.execute.return_value = [0, 1, 0]
+        rv = client.post('/api/tokens', headers=auth)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.app.redis.zrem.call_count,
+                         pipe.execute.call_count)
+
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
         self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
@@ -101,6 +325,977 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_timeline(self):
+        self.app.config['TIMELINE_ENABLED'] = True
+        self.app.config['TIMELINE_LENGTH'] = 2
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        now = datetime.now(timezone.utc)
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        db.session.add_all([p1, p2])
+        db.session.commit()
+
+        # following rebuilds the timeline from existing posts
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         [p2, p1])
+
+        # new posts are pushed to followers and timelines stay bounded
+        p3 = Post(body="another post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add(p3)
+        p3.add_to_timelines()
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(),
+                         [p3, p2])
+        self.assertEqual(db.session.scalars(u2.timeline_posts()).all(),
+                         [p3])
+
+        # deleting a post removes it from the timelines
+        db.session.execute(sa.text('PRAGMA foreign_keys = ON'))
+        db.session.delete(p3)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p2])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(db.session.scalars(u1.timeline_posts()).all(), [p1])
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        posts = [Post(body=f'post {i}', author=u,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        query = sa.select(Post).order_by(Post.timestamp.desc())
+        columns = [Post.timestamp, Post.id]
+
+        page1 = keyset_paginate(query, columns, None, 2)
+        self.assertEqual(page1.items, [posts[4], posts[3]])
+        self.assertFalse(page1.has_prev)
+        page2 = keyset_paginate(query, columns, page1.next_cursor, 2)
+        self.assertEqual(page2.items, [posts[2], posts[1]])
+        page3 = keyset_paginate(query, columns, page2.next_cursor, 2,
+                                count=True)
+        self.assertEqual(page3.items, [posts[0]])
+        self.assertFalse(page3.has_next)
+        self.assertEqual(page3.total, 5)
+        back = keyset_paginate(query, columns, page3.prev_cursor, 2)
+        self.assertEqual(back.items, page2.items)
+        back = keyset_paginate(query, columns, back.prev_cursor, 2)
+        self.assertEqual(back.items, page1.items)
+        self.assertFalse(back.has_prev)
+
+        # malformed cursors fall back to the first page
+        for values in ([[1], {}], [now.isoformat(), '1'], [1, 1],
+                       [now.isoformat(), True], {'a': 1, 'b': 2}):
+            raw = json.dumps(['next', values]).encode('utf-8')
+            cursor = base64.urlsafe_b64encode(raw).decode('ascii')
+            page = keyset_paginate(query, columns, cursor, 2)
+            self.assertEqual(page.items, page1.items)
+
+    def test_counters(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.add_all([Post(body='one', author=u1),
+                            Post(body='two', author=u1)])
+        db.session.commit()
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 2)
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u2.following_count(), 1)
+        self.assertEqual(User.check_counters(), [])
+
+        # follow and unfollow adjust both users' counters, once
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u2.followed_count), (1, 1))
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u2.followed_count), (0, 0))
+        u2.unfollow(u1)
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u2.followed_count), (0, 0))
+        u2.follow(u1)
+        db.session.commit()
+        self.assertEqual((u1.follower_count, u2.followed_count), (1, 1))
+        self.assertEqual(User.check_counters(), [])
+
+        # sending a message counts it as unread; reading them resets it
+        self.app.redis = FakeRedis()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u2.id)
+        for body in ('hello', 'again'):
+            rv = client.post('/send_message/john', data={'message': body})
+            self.assertEqual(rv.status_code, 302)
+        db.session.expire_all()
+        self.assertEqual(u1.unread_message_count(), 2)
+        self.assertEqual(User.check_counters(), [])
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        g.pop('_login_user')  # requests share the test's app context
+        self.assertEqual(client.get('/messages').status_code, 200)
+        db.session.expire_all()
+        self.assertEqual(u1.unread_message_count(), 0)
+        self.assertEqual(User.check_counters(), [])
+        db.session.execute(sa.delete(Message))
+        db.session.commit()
+
+        db.session.delete(db.session.scalar(u1.posts.select().limit(1)))
+        u1.follower_count = 5
+        db.session.commit()
+        self.assertEqual(u1.posts_count(), 1)
+        self.assertEqual(User.check_counters(),
+                         [(u1.id, 'follower_count', 5, 1)])
+        db.session.add(Message(author=u2, recipient=u1, body='hi'))
+        db.session.commit()
+        self.assertEqual(len(User.check_counters()), 2)
+        User.rebuild_counters()
+        db.session.commit()
+        self.assertEqual(u1.followers_count(), 1)
+        self.assertEqual(u1.unread_message_count(), 1)
+        self.assertEqual(User.check_counters(), [])
+
+    def test_user_collection_queries(self):
+        users = [User(username=f'user{i}', email=f'user{i}@example.com')
+                 for i in range(10)]
+        db.session.add(users[0])
+        token = users[0].get_token()
+        db.session.commit()
+        client = self.app.test_client()
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        def get_users():
+            self.app.token_cache.clear()
+            statements.clear()
+            rv = client.get('/api/users?per_page=100',
+                            headers={'Authorization': f'Bearer {token}'})
+            self.assertEqual(rv.status_code, 200)
+            return len(rv.get_json()['items']), len(statements)
+
+        sa.event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            one = get_users()
+            db.session.add_all(users[1:])
+            db.session.commit()
+            many = get_users()
+        finally:
+            sa.event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual((one[0], many[0]), (1, 10))
+        self.assertEqual(one[1], many[1])
+
+    def test_last_seen_tracker(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        long_ago = datetime(2020, 1, 1)
+        u1.last_seen = long_ago
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        tracker = LastSeenTracker(granularity=60, flush_interval=3600)
+        tracker.touch(u1)
+        tracker.touch(u2)  # seen just now, nothing to record
+        db.session.expire_all()
+        self.assertEqual(u1.last_seen, long_ago)
+
+        # a failed write keeps the buffered values
+        with mock.patch.object(db.engine, 'begin',
+                               side_effect=sa.exc.OperationalError(
+                                   'UPDATE', {}, Exception('locked'))):
+            with self.assertRaises(sa.exc.OperationalError):
+                tracker.flush()
+        self.assertEqual(tracker.flush(), 1)
+        db.session.expire_all()
+        self.assertGreater(u1.last_seen, long_ago)
+
+        # with the application a background thread flushes periodically
+        u2.last_seen = long_ago
+        db.session.commit()
+        tracker = LastSeenTracker(granularity=60, flush_interval=0.1,
+                                  app=self.app)
+        tracker.touch(u2)
+        time.sleep(0.5)
+        db.session.expire_all()
+        self.assertGreater(u2.last_seen, long_ago)
+
+    def test_notification_stream(self):
+        self.app.config['NOTIFICATIONS_STREAM'] = True
+        self.app.redis = mock.MagicMock()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+
+        # notifications are published once committed, and not if rolled back
+        u.add_notification('unread_message_count', 1)
+        db.session.flush()
+        self.app.redis.pipeline.assert_not_called()
+        db.session.commit()
+        pipe = self.app.redis.pipeline.return_value
+        channel, payload = pipe.publish.call_args.args
+        self.assertEqual(channel, Notification.channel(u.id))
+        published = json.loads(payload)
+        self.assertEqual(published['data'], 1)
+        u.add_notification('unread_message_count', 2)
+        db.session.rollback()
+        self.assertEqual(pipe.publish.call_count, 1)
+
+        # the stream replays stored notifications, then relays new ones
+        later = dict(published, data=2, timestamp=published['timestamp'] + 1)
+        pubsub = self.app.redis.pubsub.return_value
+        pubsub.get_message.side_effect = [None, {'data': json.dumps(later)}]
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        rv = client.get('/notifications/stream', buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        chunks = iter(rv.response)
+        events = [next(chunks).decode() for i in range(3)]
+        rv.close()
+        pubsub.subscribe.assert_called_once_with(Notification.channel(u.id))
+        pubsub.close.assert_called_once()
+        self.assertEqual(events[0], 'id: {}\ndata: {}\n\n'.format(
+            published['timestamp'], json.dumps(published)))
+        self.assertEqual(events[1], ': heartbeat\n\n')
+        self.assertEqual(json.loads(events[2].split('data: ')[1]), later)
+
+    def test_token_cache(self):
+        self.app.redis = mock.MagicMock()
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        token = u.get_token()
+        db.session.commit()
+        self.assertEqual(User.check_token(token), u)
+        db.session.remove()
+        self.assertEqual(User.check_token(token).username, 'john')
+        self.assertEqual(self.app.token_cache.hits, 1)
+
+        # revocations are published once committed
+        u = db.session.get(User, u.id)
+        u.revoke_token()
+        self.app.redis.publish.assert_not_called()
+        db.session.commit()
+        self.app.redis.publish.assert_called_once_with(
+            TOKEN_REVOKED_CHANNEL, token)
+        self.assertIsNone(User.check_token(token))
+
+        # and drop the token from the caches of the other processes
+        self.app.token_cache.set(token, (u.id, u.token_expiration))
+        self.app.token_cache._revoked({'data': token.encode()})
+        self.assertIsNone(self.app.token_cache.get(token))
+
+        # without the subscription nothing is cached
+        cache = TokenCache(self.app, 'token')
+        self.app.redis.pubsub.side_effect = redis.exceptions.ConnectionError
+        cache.set(token, (u.id, u.token_expiration))
+        self.assertIsNone(cache.get(token))
+
+    def test_fragment_cache(self):
+        self.app.redis = FakeRedis()
+        cache = self.app.fragment_cache
+        u = User(username='john', email='john@example.com')
+        p = Post(body='first version', author=u, language='en')
+        db.session.add(p)
+        db.session.commit()
+
+        def render(locale='en'):
+            with self.app.test_request_context():
+                g.locale = locale
+                return str(render_posts([p]))
+
+        html = render()
+        self.assertIn('first version', html)
+        self.assertEqual(render(), html)
+        self.assertEqual(cache.hits, 1)
+
+        # the locale is part of the key
+        render('es')
+        self.assertEqual(cache.hits, 1)
+
+        # editing the post or its author reaches the other processes too
+        other = FragmentCache('post fragment', ttl=3600)
+        with self.app.test_request_context():
+            key = other.keys([('post', p.id, u.id, 'en')], 'en')[0]
+            other.set(key, html)
+        p.body = 'second version'
+        db.session.commit()
+        self.assertIn('second version', render())
+        with self.app.test_request_context():
+            key = other.keys([('post', p.id, u.id, 'en')], 'en')[0]
+            self.assertIsNone(other.get(key))
+        u.username = 'johnny'
+        db.session.commit()
+        self.assertIn('johnny', render())
+        self.assertEqual(cache.hits, 1)
+        render()
+        self.assertEqual(cache.hits, 2)
+
+        # a page of posts costs a single Redis round trip
+        self.app.redis = mock.MagicMock(wraps=FakeRedis())
+        db.session.add_all([Post(body=f'post {i}', author=u)
+                            for i in range(5)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        g.pop('_login_user', None)  # requests share the test's app context
+        for i in range(2):
+            rv = client.get('/explore')
+            self.assertEqual(rv.status_code, 200)
+            self.assertIn('post 4', rv.get_data(as_text=True))
+        self.assertEqual(self.app.redis.mget.call_count, 2)
+        self.assertEqual(len(self.app.redis.mget.call_args.args[0]), 7)
+        self.assertEqual(cache.hits, 9)
+
+    def test_local_search(self):
+        self.app.redis = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat on the mat', author=u)
+        p2 = Post(body='cat cat cat', author=u)
+        p3 = Post(body='a dog', author=u)
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(list(posts), [p2, p1])
+        posts, total = Post.search('dog cat', 1, 1)
+        self.assertEqual(total, 3)
+        self.assertEqual(list(posts), [p3])
+
+        p3.body = 'a bird'
+        db.session.delete(p2)
+        db.session.commit()
+        self.assertEqual(Post.search('dog', 1, 10)[1], 0)
+        posts, total = Post.search('cat bird', 1, 10)
+        self.assertEqual(list(posts), [p3, p1])
+        posts, total = Post.search('cat bird', 2, 1)
+        self.assertEqual((list(posts), total), ([p1], 2))
+
+        # document count and total length are kept up to date by bulk()
+        stats = db.session.execute(sa.select(
+            search_stats.c.documents, search_stats.c.length)).one()
+        self.assertEqual(tuple(stats), (2, 8))
+
+    def test_language_detection(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='Hola amigos, ¿cómo están todos hoy?', author=u)
+        p2 = Post(body='hi!', author=u)
+        p3 = Post(body='This one was already detected', author=u,
+                  language='en')
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertIsNone(p1.language)
+        ids = [p1.id, p2.id, p3.id]
+        queue = mock.MagicMock()
+        with mock.patch.dict(self.app.task_queues, high=queue):
+            detect_languages_later(ids)
+        queue.enqueue.assert_called_once_with(
+            'app.tasks.detect_post_languages', ids)
+        self.assertIsNone(p1.language)
+
+        self.assertEqual(detect_post_languages(ids), 2)
+        self.assertEqual(p1.language, 'es')
+        self.assertEqual(p2.language, 'und')
+        self.assertEqual(p3.language, 'en')
+
+        # without Redis the detection runs inline
+        p4 = Post(body='Bonjour tout le monde, comment allez-vous?', author=u)
+        db.session.add(p4)
+        db.session.commit()
+        queue.enqueue.side_effect = redis.exceptions.ConnectionError
+        with mock.patch.dict(self.app.task_queues, high=queue):
+            detect_languages_later([p4.id])
+        self.assertEqual(p4.language, 'fr')
+
+        # the backfill retries posts that failed before 'und' was stored,
+        # and only once
+        p5 = Post(body='ok!', author=u, language='')
+        db.session.add(p5)
+        db.session.commit()
+        ids = [p2.id, p4.id, p5.id]
+        runner = self.app.test_cli_runner()
+        args = ['posts', 'detect-language', '--processes', '1']
+        with mock.patch('app.cli.ProcessPoolExecutor', ThreadPoolExecutor), \
+                mock.patch('app.cli.detect_language',
+                           wraps=detect_language) as detect:
+            self.assertIn('0 post languages detected',
+                          runner.invoke(args=args).output)
+            self.assertEqual(detect.call_count, 1)
+            runner.invoke(args=args)
+            self.assertEqual(detect.call_count, 1)
+        p2, p4, p5 = [db.session.get(Post, id) for id in ids]
+        self.assertEqual(p5.language, 'und')
+
+        # undetermined posts offer no translation
+        self.app.redis = FakeRedis()
+        with self.app.test_request_context():
+            g.locale = 'en'
+            self.assertNotIn('Translate', str(render_posts([p2])))
+            self.assertIn('Translate', str(render_posts([p4])))
+
+    def test_search_cache(self):
+        self.app.redis = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        db.session.add(Post(body='the cat sat', author=u))
+        db.session.commit()
+        self.assertEqual(Post.search('cat', 1, 10)[1], 1)
+        self.assertEqual(Post.search('  CAT ', 1, 10)[1], 1)
+        self.assertEqual(self.app.search_cache.hits, 1)
+
+        db.session.add(Post(body='another cat', author=u))
+        db.session.commit()
+        self.assertEqual(Post.search('cat', 1, 10)[1], 2)
+        self.assertEqual(self.app.search_cache.hits, 1)
+
+    def test_elasticsearch_refresh(self):
+        client = mock.MagicMock()
+        client.bulk.return_value = {'errors': False, 'items': []}
+        backend = ElasticsearchBackend(client)
+        backend.bulk([('delete', 'post', 1, None)])
+        self.assertNotIn('refresh', client.bulk.call_args.kwargs)
+        backend.swap_alias('post', 'post-1')
+        client.indices.refresh.assert_called_once_with(index='post-1')
+
+        # results cached before the index is refreshed expire with the
+        # refresh interval
+        self.app.redis = FakeRedis()
+        cache = SearchCache('search', ttl=300, refresh_interval=0.2)
+        cache.bump('post')
+        key, expires_at = cache.key('post', 'cat', 1, 10)
+        self.assertIsNotNone(expires_at)
+        cache.set(key, ([], 0), expires_at)
+        self.assertEqual(cache.get(key), ([], 0))
+        time.sleep(0.25)
+        self.assertIsNone(cache.get(key))
+        self.assertEqual(cache.key('post', 'cat', 1, 10), (key, None))
+        # another process sees when the index changed
+        other = SearchCache('search', ttl=300, refresh_interval=0.2)
+        other.bump('post')
+        self.assertIsNotNone(cache.key('post', 'cat', 1, 10)[1])
+
+    def test_elasticsearch_bulk_retries(self):
+        self.app.config['SEARCH_BULK_RETRIES'] = 2
+        self.app.config['SEARCH_BULK_BACKOFF'] = 0.1
+
+        def item(op, status, error=False):
+            result = {'status': status}
+            if error:
+                result['error'] = {'type': 'some_exception'}
+            return {op: result}
+
+        client = mock.MagicMock()
+        client.bulk.side_effect = [
+            {'errors': True, 'items': [
+                item('index', 201), item('index', 429, True),
+                item('index', 400, True), item('delete', 404),
+                item('index', 503, True)]},
+            {'errors': True, 'items': [
+                item('index', 201), item('index', 503, True)]},
+            {'errors': True, 'items': [item('index', 503, True)]},
+        ]
+        actions = [('index', 'post', 1, {'body': 'a'}),
+                   ('index', 'post', 2, {'body': 'b'}),
+                   ('index', 'post', 3, {'body': 'c'}),
+                   ('delete', 'post', 4, None),
+                   ('index', 'post', 5, {'body': 'e'})]
+        backend = ElasticsearchBackend(client)
+        with mock.patch('app.search.time.sleep') as sleep, \
+                self.assertLogs(self.app.logger, 'ERROR') as logs:
+            failed = backend.bulk(actions)
+        # 429/5xx items are retried with backoff, 4xx items are dropped and
+        # a missing document is already deleted
+        self.assertEqual(failed, [actions[4]])
+        self.assertEqual([c.args[0] for c in sleep.call_args_list],
+                         [0.1, 0.2])
+        resent = [[op['index']['_id'] for op in c.kwargs['operations']
+                   if 'index' in op] for c in client.bulk.call_args_list]
+        self.assertEqual(resent, [[1, 2, 3, 5], [2, 5], [5]])
+        self.assertIn('Could not index post/3', logs.output[0])
+        self.assertIn('Gave up indexing 1 actions', logs.output[1])
+
+        # failed requests are retried as a whole
+        client.bulk.side_effect = [ElasticConnectionError('down'),
+                                   {'errors': False, 'items': []}]
+        with mock.patch('app.search.time.sleep'):
+            self.assertEqual(backend.bulk(actions[:1]), [])
+        self.assertEqual(client.bulk.call_count, 5)
+
+    def test_search_hydrate(self):
+        self.app.redis = FakeRedis()
+        self.app.config['SEARCH_HYDRATE'] = True
+        u = User(username='john', email='john@example.com')
+        p = Post(body='the cat sat', author=u, language='en')
+        db.session.add(p)
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(total, 1)
+        self.assertIsInstance(posts[0], PostResult)
+        self.assertEqual(posts[0].id, p.id)
+        self.assertEqual(posts[0].language, 'en')
+        self.assertEqual(posts[0].author.avatar(36), u.avatar(36))
+
+        # a search worker reindexes the posts of a renamed author
+        from app.tasks import reindex_author_posts
+        self.app.search_queue = mock.MagicMock()
+        u.username = 'johnny'
+        db.session.commit()
+        self.app.search_queue.enqueue.assert_called_once_with(
+            'app.tasks.reindex_author_posts', [u.id])
+        reindex_author_posts([u.id])
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(posts[0].author.username, 'johnny')
+
+        # or the request does, when Redis is unavailable
+        self.app.search_queue.enqueue.side_effect = \
+            redis.exceptions.ConnectionError
+        u = db.session.get(User, u.id)
+        u.username = 'jon'
+        db.session.commit()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(posts[0].author.username, 'jon')
+
+        db.session.execute(search_document.update().values(source=None))
+        db.session.commit()
+        self.app.search_cache.clear()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertIsInstance(posts[0], Post)
+        self.assertEqual(posts[0].body, 'the cat sat')
+
+    def test_mail_dispatcher(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        recorder = SMTPRecorder()
+        controller = Controller(recorder, hostname='127.0.0.1', port=port)
+        controller.start()
+        try:
+            state = self.app.extensions['mail']
+            state.server, state.port, state.suppress = '127.0.0.1', port, False
+            self.app.mail_dispatcher = MailDispatcher(self.app, workers=1,
+                                                      batch_size=10)
+            for i in range(5):
+                send_email(f'message {i}', sender='admin@example.com',
+                           recipients=['john@example.com'],
+                           text_body='hello', html_body='<p>hello</p>')
+            # a message that cannot be sent does not stop the others
+            send_email('bad\nsubject', sender='admin@example.com',
+                       recipients=['john@example.com'],
+                       text_body='hello', html_body='<p>hello</p>')
+            send_email('message 5', sender='admin@example.com',
+                       recipients=['john@example.com'],
+                       text_body='hello', html_body='<p>hello</p>')
+            self.assertTrue(self.app.mail_dispatcher.flush(timeout=10))
+        finally:
+            controller.stop()
+        self.assertEqual(len(recorder.messages), 6)
+        self.assertEqual(recorder.connections, 2)
+        stats = self.app.mail_dispatcher.stats()
+        self.assertEqual((stats['sent'], stats['failed']), (6, 1))
+
+    def test_translation_cache(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), TranslatorStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        TranslatorStub.requests = []
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = \
+            f'http://127.0.0.1:{server.server_port}'
+        try:
+            self.assertEqual(translate_batch(['hola', 'mundo', 'hola'],
+                                             'es', 'en'),
+                             ['HOLA', 'MUNDO', 'HOLA'])
+            self.assertEqual(TranslatorStub.requests,
+                             [[{'Text': 'hola'}, {'Text': 'mundo'}]])
+            self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+            self.app.translation_cache.clear()
+            self.assertEqual(translate('mundo', 'es', 'en'), 'MUNDO')
+            self.assertEqual(len(TranslatorStub.requests), 1)
+            self.assertEqual(translate('mundo', 'es', 'de'), 'MUNDO')
+            self.assertEqual(len(TranslatorStub.requests), 2)
+
+            # another process stores 'hola' between our delete and insert
+            with mock.patch.object(
+                    translation_cache, 'delete',
+                    return_value=translation_cache.delete().where(sa.false())):
+                _store_translations({text_hash('hola'): 'HI',
+                                     text_hash('adios'): 'BYE'}, 'es', 'en')
+            rows = dict(db.session.execute(
+                sa.select(translation_cache.c.text_hash,
+                          translation_cache.c.translation)
+                .where(translation_cache.c.dest == 'en')).all())
+            self.assertEqual(rows[text_hash('hola')], 'HOLA')
+            self.assertEqual(rows[text_hash('adios')], 'BYE')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_pretranslate(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), TranslatorStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        TranslatorStub.requests = []
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = \
+            f'http://127.0.0.1:{server.server_port}'
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        db.session.add_all([
+            Post(body='hola', author=u, language='es', timestamp=now),
+            Post(body='hello', author=u, language='en', timestamp=now),
+            Post(body='ok', author=u, language='', timestamp=now),
+            Post(body='adios', author=u, language='es',
+                 timestamp=now - timedelta(days=2))])
+        db.session.commit()
+        try:
+            self.assertEqual(pretranslate_posts(hours=24), 2)
+            self.assertEqual(sorted(map(str, TranslatorStub.requests)),
+                             ["[{'Text': 'hello'}]", "[{'Text': 'hola'}]"])
+            self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+            self.assertEqual(pretranslate_posts(hours=24), 0)
+            self.assertEqual(len(TranslatorStub.requests), 2)
+
+            # failed translations are not counted
+            db.session.add(Post(body='buenas', author=u, language='es',
+                                timestamp=now))
+            db.session.commit()
+            TranslatorStub.status = 500
+            self.assertEqual(pretranslate_posts(hours=24), 0)
+            TranslatorStub.status = 200
+            self.assertEqual(pretranslate_posts(hours=24), 1)
+        finally:
+            TranslatorStub.status = 200
+            server.shutdown()
+            server.server_close()
+
+    def test_translator_circuit_breaker(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), TranslatorStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        TranslatorStub.requests = []
+        TranslatorStub.status, TranslatorStub.delay = 500, 0
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = \
+            f'http://127.0.0.1:{server.server_port}'
+        self.app.translator = HTTPClient(timeout=(1, 0.2), retries=0,
+                                         failure_threshold=2,
+                                         reset_timeout=0.3)
+        failed = 'Error: the translation service failed.'
+        try:
+            for text in ('a', 'b', 'c'):
+                self.assertEqual(translate(text, 'es', 'en'), failed)
+            self.assertEqual(len(TranslatorStub.requests), 2)
+
+            time.sleep(0.3)
+            TranslatorStub.status, TranslatorStub.delay = 200, 0.5
+            start = time.monotonic()
+            self.assertEqual(translate('d', 'es', 'en'), failed)
+            self.assertLess(time.monotonic() - start, 0.5)
+
+            time.sleep(0.3)
+            TranslatorStub.delay = 0
+            self.assertEqual(translate('e', 'es', 'en'), 'E')
+            self.assertEqual(translate('f', 'es', 'en'), 'F')
+        finally:
+            TranslatorStub.status, TranslatorStub.delay = 200, 0
+            server.shutdown()
+            server.server_close()
+
+    def test_translator_throttled(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), TranslatorStub)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        TranslatorStub.requests = []
+        TranslatorStub.status, TranslatorStub.retry_after = 429, '600'
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = \
+            f'http://127.0.0.1:{server.server_port}'
+        self.app.translator = HTTPClient(timeout=(1, 1), retries=2,
+                                         failure_threshold=2,
+                                         reset_timeout=30)
+        failed = 'Error: the translation service failed.'
+        try:
+            # a long Retry-After is not honoured
+            start = time.monotonic()
+            self.assertEqual(translate('a', 'es', 'en'), failed)
+            self.assertLess(time.monotonic() - start, 2)
+            self.assertEqual(len(TranslatorStub.requests), 3)
+            # and throttling opens the circuit
+            self.assertEqual(translate('b', 'es', 'en'), failed)
+            self.assertEqual(translate('c', 'es', 'en'), failed)
+            self.assertEqual(len(TranslatorStub.requests), 6)
+        finally:
+            TranslatorStub.status, TranslatorStub.retry_after = 200, None
+            server.shutdown()
+            server.server_close()
+
+    def test_async_indexing(self):
+        from app.tasks import apply_index_ops
+        self.app.config['SEARCH_ASYNC'] = True
+        self.app.redis = FakeRedis()
+        self.app.search_queue = mock.MagicMock()
+        self.app.search_backend = FlakyBackend(fail=[1])
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='the cat sat', author=u)
+        p2 = Post(body='another cat', author=u)
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        self.app.search_queue.enqueue.assert_called_once_with(
+            'app.tasks.apply_index_ops')
+        self.assertEqual(Post.search('cat', 1, 10)[1], 0)
+
+        # changes that fail to index stay queued for a delayed retry
+        apply_index_ops()
+        self.assertEqual(self.app.redis.llen(PENDING_OPS_KEY), 2)
+        self.app.search_queue.enqueue_in.assert_called_once()
+        apply_index_ops()
+        self.assertEqual(self.app.redis.llen(PENDING_OPS_KEY), 0)
+        self.assertEqual(Post.search('cat', 1, 10)[1], 2)
+
+        p2_id = p2.id
+        db.session.delete(p1)
+        db.session.commit()
+        apply_index_ops()
+        posts, total = Post.search('cat', 1, 10)
+        self.assertEqual(([post.id for post in posts], total), ([p2_id], 1))
+
+    def test_task_progress(self):
+        self.app.redis = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        t1 = Task(id='job-1', name='export_posts', user=u)
+        t2 = Task(id='job-2', name='export_posts', user=u)
+        db.session.add_all([t1, t2])
+        db.session.commit()
+        self.assertEqual(u.get_task_progress(), {})
+        t1.set_progress(30)
+        t2.set_progress(60)
+        self.assertEqual(u.get_task_progress(), {'job-1': 30, 'job-2': 60})
+        t1.set_progress(100)
+        self.assertEqual(u.get_task_progress(), {'job-2': 60})
+
+        # without a hash entry the banner shows the progress stored on the row
+        t1.description, t2.description = 'First export', 'Second export'
+        t2.progress = 40
+        db.session.commit()
+        self.app.redis.delete(Task.progress_key(u.id))
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        g.pop('_login_user', None)  # requests share the test's app context
+        html = client.get('/explore').get_data(as_text=True)
+        self.assertIn('<span id="job-2-progress">40</span>%', html)
+
+        self.app.redis = mock.MagicMock()
+        self.app.redis.hgetall.side_effect = redis.exceptions.ConnectionError
+        self.assertEqual(u.get_task_progress(), {})
+
+    def test_task_queues(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        queues = {name: mock.MagicMock() for name in self.app.task_queues}
+        queues['bulk'].enqueue.return_value.id = 'job-1'
+        with mock.patch.dict(self.app.task_queues, queues):
+            task = u.launch_task('export_posts', 'Exporting posts...',
+                                 queue='bulk')
+        queues['bulk'].enqueue.assert_called_once_with(
+            'app.tasks.export_posts', u.id)
+        queues['default'].enqueue.assert_not_called()
+        self.assertEqual(task.id, 'job-1')
+
+        # the worker records how long each job waited in its queue
+        self.app.redis = FakeRedis()
+        worker = Worker.__new__(Worker)
+        worker.connection, worker.log = self.app.redis, mock.MagicMock()
+        job = mock.MagicMock(func_name='app.tasks.export_posts')
+        job.enqueued_at = datetime.now(timezone.utc) - timedelta(seconds=3)
+        queue = mock.MagicMock(count=2)
+        queue.name = 'microblog-tasks-bulk'
+        with mock.patch.object(rq.Worker, 'execute_job') as execute_job:
+            worker.execute_job(job, queue)
+        execute_job.assert_called_once_with(job, queue)
+        latency = self.app.redis.hgetall(QUEUE_LATENCY_KEY)
+        self.assertAlmostEqual(float(latency[b'microblog-tasks-bulk']), 3,
+                               delta=1)
+
+        # `flask queues` shows the depth and last wait of every queue
+        queues = {}
+        for i, name in enumerate(WORKER_QUEUES):
+            queues[name] = mock.MagicMock(count=i)
+            queues[name].name = f'microblog-tasks-{name}'
+        with mock.patch.dict(self.app.task_queues, queues), \
+                mock.patch.object(self.app, 'search_queue',
+                                  queues['search']):
+            result = self.app.test_cli_runner().invoke(args=['queues'])
+        self.assertEqual(result.exit_code, 0)
+        lines = result.output.splitlines()
+        self.assertEqual([line.split(':')[0] for line in lines],
+                         WORKER_QUEUES)
+        self.assertIn('bulk: 3 queued, last wait 3.0s', lines)
+        self.assertIn('high: 0 queued, last wait 0.0s', lines)
+
+    def test_progress_reporter(self):
+        from app import tasks
+        with mock.patch.object(tasks, '_set_task_progress') as report:
+            progress = tasks.ProgressReporter(min_delta=5, interval=60)
+            for percent in (1, 2, 6, 6, 7, 12, 100):
+                progress.update(percent)
+            progress.finish()
+            self.assertEqual([c.args[0] for c in report.call_args_list],
+                             [1, 6, 12, 100])
+
+            report.reset_mock()
+            progress = tasks.ProgressReporter(min_delta=5, interval=0)
+            for percent in (1, 2, 3):
+                progress.update(percent)
+            progress.finish()
+            self.assertEqual([c.args[0] for c in report.call_args_list],
+                             [1, 2, 3, 100])
+
+        # a report writes the job meta and progress hash in one round trip
+        u = User(username='john', email='john@example.com')
+        task = Task(id='job-1', name='export_posts', user=u)
+        db.session.add(task)
+        db.session.commit()
+        self.app.redis = FakeRedis()
+        job = mock.MagicMock(id='job-1', key='rq:job:job-1', meta={})
+        job.connection = mock.MagicMock()
+        job.connection.pipeline.return_value = FakePipeline(self.app.redis)
+        with mock.patch.object(tasks, 'get_current_job', return_value=job):
+            tasks._set_task_progress(40)
+        self.assertEqual(job.connection.pipeline.call_count, 1)
+        job.save_meta.assert_not_called()
+        self.assertEqual(u.get_task_progress(), {'job-1': 40})
+        self.assertEqual(json.loads(db.session.scalar(
+            u.notifications.select()).payload_json)['progress'], 40)
+
+    def test_export_posts(self):
+        from app import tasks
+        self.app.config['EXPORT_CHUNK_SIZE'] = 3
+        self.app.redis = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        now = datetime.now(timezone.utc)
+        # pairs of posts share a timestamp, so chunks can split a tie
+        db.session.add_all([Post(body=f'post {i}', author=u,
+                                 timestamp=now + timedelta(seconds=i // 2))
+                            for i in range(8)])
+        task = Task(id='job-1', name='export_posts', user=u)
+        db.session.add(task)
+        db.session.commit()
+        job = mock.MagicMock(id='job-1', key='rq:job:job-1', meta={})
+        job.connection.pipeline.side_effect = \
+            lambda: FakePipeline(self.app.redis)
+        with mock.patch.object(tasks, 'app', self.app), \
+                mock.patch.object(tasks, 'get_current_job',
+                                  return_value=job), \
+                mock.patch.object(tasks, 'send_email') as send_email, \
+                mock.patch.object(tasks, '_set_task_progress',
+                                  wraps=tasks._set_task_progress) as report:
+            tasks.export_posts(u.id)
+        name, mimetype, data = \
+            send_email.call_args.kwargs['attachments'][0]
+        self.assertEqual((name, mimetype),
+                         ('posts.jsonl.gz', 'application/gzip'))
+        lines = gzip.decompress(data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['body'] for line in lines],
+                         [f'post {i}' for i in range(8)])
+        reported = [c.args[0] for c in report.call_args_list]
+        self.assertEqual(reported, sorted(reported))
+        self.assertEqual((reported[0], reported[-1]), (0, 100))
+        self.assertEqual(job.meta['progress'], 100)
+        self.assertEqual(u.get_task_progress(), {})
+        db.session.refresh(task)
+        self.assertTrue(task.complete)
+
+    def test_reindex(self):
+        self.app.redis = FakeRedis()
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body=f'post number {i}', author=u) for i in range(7)]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = [post.id for post in posts]
+        for table in (search_term, search_document):
+            db.session.execute(table.delete())
+        db.session.commit()
+        self.assertEqual(Post.search('post', 1, 10)[1], 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, 'checkpoint.json')
+            with open(checkpoint, 'w') as f:
+                json.dump({'index': 'post', 'last_id': ids[2]}, f)
+            result = Post.reindex(chunk_size=2, workers=2,
+                                  checkpoint=checkpoint)
+            self.assertEqual(result['indexed'], 4)
+            self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Post.search('post', 1, 10)[1], 4)
+
+        result = Post.reindex(chunk_size=3, new_index=True)
+        self.assertEqual(result['indexed'], 7)
+        self.assertEqual(Post.search('post', 1, 10)[1], 7)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).where(
+            search_document.c.index != 'post')), 0)
+
+        # a failed chunk stops the run before the swap and keeps the
+        # checkpoint there
+        self.app.search_backend = FlakyBackend(fail=[2])
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, 'checkpoint.json')
+            result = Post.reindex(chunk_size=2, checkpoint=checkpoint,
+                                  new_index=True)
+            self.assertEqual(result['failed'], 2)
+            self.assertFalse(result['swapped'])
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f)['last_id'], ids[1])
+            self.assertEqual(Post.search('post', 1, 10)[1], 7)
+
+            self.app.search_backend.fail = []
+            result = Post.reindex(chunk_size=2, checkpoint=checkpoint)
+            self.assertEqual((result['indexed'], result['failed']), (5, 0))
+            self.assertTrue(result['swapped'])
+            self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Post.search('post', 1, 10)[1], 7)
+        self.assertEqual(db.session.scalar(sa.select(sa.func.count()).where(
+            search_document.c.index != 'post')), 0)
+
+        # a post added during the build is indexed after the swap; if that
+        # fails the command fails and keeps a checkpoint on the live index
+        from app import models
+        swap_alias = models.swap_alias
+
+        def swap_and_post(alias, index):
+            swap_alias(alias, index)
+            db.session.add(Post(body='late post', author=u))
+            db.session.commit()
+
+        # bulk calls: two chunks, the live index, then the late pass
+        self.app.search_backend = FlakyBackend(fail=[4])
+        runner = self.app.test_cli_runner()
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch.object(self.app, 'instance_path', tmp), \
+                mock.patch('app.models.swap_alias', swap_and_post):
+            args = ['search', 'reindex', 'post', '--new-index',
+                    '--chunk-size', '4', '--workers', '1']
+            result = runner.invoke(args=args)
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn('was swapped in', result.output)
+            checkpoint = os.path.join(tmp, 'reindex-post.json')
+            with open(checkpoint) as f:
+                self.assertEqual(json.load(f),
+                                 {'index': 'post', 'last_id': ids[-1]})
+
+            self.app.search_backend.fail = []
+            result = runner.invoke(args=args)
+            self.assertEqual(result.exit_code, 0)
+            self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Post.search('post', 1, 10)[1], 8)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file